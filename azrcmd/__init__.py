@@ -3,21 +3,61 @@ import io
 import os
 import re
 import sys
+import copy
+import json
+import time
+import zlib
 import pytz
+import errno
 import base64
+import socket
+import shutil
+import binascii
+import calendar
+import pstats
+import cProfile
+import requests
 import hashlib
 import argparse
 import datetime
+import mimetypes
+import threading
+import traceback
+import itertools
+import contextlib
+import collections
+import multiprocessing
+import concurrent.futures
 from math import log
-from azure.storage.blob import BlockBlobService
+from azure.common import AzureHttpError, AzureMissingResourceHttpError
+from azure.storage.blob import BlockBlobService, Include, ContentSettings, BlobBlock
 from progressbar import ProgressBar, Percentage, Bar, ETA, FileTransferSpeed
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 if sys.version_info[0] == 3:
+    import queue
+    import socketserver
     import urllib.parse
     urlparse = urllib.parse.urlparse
+    unquote = urllib.parse.unquote
+    quote = urllib.parse.quote
 else:
+    import Queue as queue
+    import urllib
     import urlparse
+    import SocketServer as socketserver
     urlparse = urlparse.urlparse
+    unquote = urllib.unquote
+    quote = urllib.quote
 
 class CredentialsMissing(RuntimeError):
     pass
@@ -25,6 +65,9 @@ class CredentialsMissing(RuntimeError):
 class NotSupported(RuntimeError):
     pass
 
+class InvalidLimit(ValueError):
+    pass
+
 class InvalidBlobStorePath(AttributeError):
     pass
 
@@ -37,6 +80,59 @@ class DirectoryRequired(AttributeError):
 class FileIsNotExists(AttributeError):
     pass
 
+class InvalidCheckpoint(ValueError):
+    pass
+
+class DaemonIsRunning(RuntimeError):
+    pass
+
+# Upper bounds (in seconds) of the histogram buckets used for timings.
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, float('inf'))
+
+# Block sizes used by the transfer scheduler. The storage API version of the SDK limits the
+# uploaded blocks to 4MB, ranged downloads can use larger chunks.
+MIN_UPLOAD_BLOCK_SIZE = 1024 * 1024
+MAX_UPLOAD_BLOCK_SIZE = 4 * 1024 * 1024
+MIN_DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+MAX_DOWNLOAD_CHUNK_SIZE = 32 * 1024 * 1024
+
+# Files from this size are considered large and will share the connection budget between them.
+LARGE_FILE_SIZE = 64 * 1024 * 1024
+
+# Fields can be selected for the machine-readable `ls` output.
+LIST_FIELDS = ('name', 'url', 'size', 'last_modified', 'md5', 'etag', 'content_type', 'content_encoding', 'metadata')
+
+# Input chunks are compressed independently (as gzip members or zstd frames) with this size.
+COMPRESSION_CHUNK_SIZE = 4 * 1024 * 1024
+# Linux ioctl which shares the extents of two files (copy-on-write copy).
+FICLONE = 0x40049409
+CACHE_MODES = ('copy', 'reflink', 'hardlink')
+# Suffix of the files which keep the last use of the hard linked cache entries.
+CACHE_USED_SUFFIX = '.used'
+# A full cache is evicted down to this fraction of its size, so the next stores do not scan it again.
+CACHE_LOW_WATER = 0.9
+
+# Seconds between the status checks of a pending server-side copy.
+COPY_POLL_INTERVAL = 1.0
+
+# Local path which means the standard output in `get`.
+STDOUT_PATH = '-'
+# Slices of the concurrent downloads to the standard output are buffered up to this size, the larger ones hold the output.
+STDOUT_BUFFER_SIZE = 8 * 1024 * 1024
+# Size of the reusable buffers of the local reads (a multiple of the page size).
+READ_BUFFER_SIZE = 1024 * 1024
+COMPRESSION_CODECS = ('gzip', 'zstd')
+
+# Metadata of the compressed blobs with the size and the MD5 hash of the original file.
+RAW_LENGTH_METADATA = 'azrcmd_raw_length'
+RAW_MD5_METADATA = 'azrcmd_raw_md5'
+
+# Binary multipliers of the size suffixes.
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+# Maps the HTTP methods to the operation name used in the metrics.
+REQUEST_OPERATIONS = {'GET': 'get', 'HEAD': 'head', 'PUT': 'put', 'DELETE': 'delete'}
+
 # void
 def check_credentials():
     if 'AZURE_STORAGE_ACCOUNT' not in os.environ:
@@ -66,12 +162,30 @@ def get_local_files(paths, recursive=False):
             for sub_path in get_local_files(sub_files, recursive=recursive):
                 yield sub_path
 
+# int
+def get_raw_length(blob):
+    metadata = getattr(blob, 'metadata', None) or {}
+    if getattr(blob, 'content_encoding', None) and RAW_LENGTH_METADATA in metadata:
+        return int(metadata[RAW_LENGTH_METADATA])
+    return blob.content_length
+
+# byte
+def get_raw_md5(blob):
+    metadata = getattr(blob, 'metadata', None) or {}
+    if getattr(blob, 'content_encoding', None) and RAW_LENGTH_METADATA in metadata:
+        return base64.b64decode(metadata[RAW_MD5_METADATA]) if metadata.get(RAW_MD5_METADATA) else None
+    return blob.content_md5
+
 # Blob|str
-def get_fresher(blob, file_path):
+def get_fresher(blob, file_path, stats=None, raw=False):
+    stat = os.stat(file_path)
+    if stats is not None:
+        stats.incr('stat_calls')
+
     blob_dt = blob.last_modified
-    file_dt = datetime.datetime.utcfromtimestamp(os.path.getmtime(file_path)).replace(tzinfo=pytz.UTC)
-    blob_cl = blob.content_length
-    file_cl = os.path.getsize(file_path)
+    file_dt = datetime.datetime.utcfromtimestamp(stat.st_mtime).replace(tzinfo=pytz.UTC)
+    blob_cl = get_raw_length(blob) if raw else blob.content_length
+    file_cl = stat.st_size
     fresher = [file_path, None, blob][(blob_dt>file_dt)-(blob_dt<file_dt)+1]
 
     if file_cl != blob_cl:
@@ -83,54 +197,1205 @@ def get_fresher(blob, file_path):
     if file_cl > 1024*1024*64:
         return None
 
-    if blob.content_md5 == md5(file_path):
+    if (get_raw_md5(blob) if raw else blob.content_md5) == md5(file_path, stats=stats):
         return None
 
     return fresher
 
+# void
+def advise(f, advice, offset=0, length=0):
+    # `posix_fadvise` is only a hint, it is missing on Python 2 and on OSX.
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(f.fileno(), offset, length, getattr(os, advice))
+        except (OSError, AttributeError):
+            pass
+
+# file
+@contextlib.contextmanager
+def open_sequential(file_path):
+    # Read ahead aggressively and drop the pages from the cache afterwards, so big backups don't evict everything else.
+    with io.open(file_path, 'rb', buffering=READ_BUFFER_SIZE) as f:
+        advise(f, 'POSIX_FADV_SEQUENTIAL')
+        try:
+            yield f
+        finally:
+            advise(f, 'POSIX_FADV_DONTNEED')
+
+_read_buffers = threading.local()
+
+# bytearray
+def get_read_buffer():
+    # One buffer per thread, reused between the files.
+    if not hasattr(_read_buffers, 'buffer'):
+        _read_buffers.buffer = bytearray(READ_BUFFER_SIZE)
+    return _read_buffers.buffer
+
 # byte
-def md5(fname):
+def md5(fname, stats=None):
     hash = hashlib.md5()
-    with io.open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash.update(chunk)
+    start, size = time.time(), 0
+    buffer = get_read_buffer()
+    view = memoryview(buffer)
+    with open_sequential(fname) as f:
+        while True:
+            count = f.readinto(buffer)
+            if not count:
+                break
+            hash.update(view[:count])
+            size += count
+
+    if stats is not None:
+        stats.incr('hash_bytes', size)
+        stats.observe('hash_seconds', time.time() - start)
     return hash.digest()
 
-class Blob(object):
+# genexp<object>
+def ordered_map(executor, fn, iterable, window):
+    # Like `executor.map`, but only keeps `window` items in flight.
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+# function
+def get_compressor(codec):
+    if codec == 'gzip':
+        def compress(data):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            return compressor.compress(data) + compressor.flush()
+        return compress
+
+    if codec == 'zstd':
+        if zstandard is None:
+            raise NotSupported(u'The `zstandard` package is required for zstd compression.')
+        return lambda data: zstandard.ZstdCompressor().compress(data)
+
+    raise NotSupported(u'Compression is not supported: `{}`'.format(codec))
+
+class Decompressor(object):
     # void
-    def __init__(self, service, blob):
-        self.service = service
-        self.blob = blob
+    def __init__(self, codec):
+        if codec == 'zstd' and zstandard is None:
+            raise NotSupported(u'The `zstandard` package is required for zstd decompression.')
+        if codec not in COMPRESSION_CODECS:
+            raise NotSupported(u'Decompression is not supported: `{}`'.format(codec))
+
+        self.codec = codec
+        self.decompressor = self.create()
+
+    # object
+    def create(self):
+        if self.codec == 'zstd':
+            return zstandard.ZstdDecompressor().decompressobj()
+        return zlib.decompressobj(31)
+
+    # byte
+    def decompress(self, data):
+        # The content is a series of independent gzip members or zstd frames.
+        output = []
+        while data:
+            # A chunk can end exactly where a frame ends, the finished decompressor can't take the next one.
+            if getattr(self.decompressor, 'eof', False):
+                self.decompressor = self.create()
+            output.append(self.decompressor.decompress(data))
+            data = self.decompressor.unused_data
+            if data:
+                self.decompressor = self.create()
+        return b''.join(output)
+
+class CompressingReader(object):
+    # void
+    def __init__(self, file_path, codec, executor, workers=1, chunk_size=COMPRESSION_CHUNK_SIZE):
+        self.file = io.open(file_path, 'rb')
+        advise(self.file, 'POSIX_FADV_SEQUENTIAL')
+        self.chunk_size = chunk_size
+        self.hash = hashlib.md5()
+        self.length = 0
+        self.buffer = bytearray()
+        self.chunks = ordered_map(executor, get_compressor(codec), self.read_chunks(), max(2, workers * 2))
+
+    # genexp<byte>
+    def read_chunks(self):
+        empty = True
+        for chunk in iter(lambda: self.file.read(self.chunk_size), b''):
+            self.hash.update(chunk)
+            self.length += len(chunk)
+            empty = False
+            yield chunk
+
+        # Even the empty files have to be valid compressed streams.
+        if empty:
+            yield b''
+
+    # byte
+    def read(self, count):
+        while len(self.buffer) < count:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer.extend(chunk)
 
-    @property
-    def last_modified(self):
-        return self.blob.properties.last_modified.replace(tzinfo=pytz.UTC)
+        data = bytes(self.buffer[:count])
+        del self.buffer[:count]
+        return data
 
-    @property
-    def content_length(self):
-        return self.blob.properties.content_length
+    # dict
+    def get_metadata(self):
+        return {RAW_LENGTH_METADATA: str(self.length), RAW_MD5_METADATA: base64.b64encode(self.hash.digest()).decode('ascii')}
 
-    @property
-    def content_md5(self):
-        if not self.blob.properties.content_settings.content_md5:
+    # void
+    def close(self):
+        advise(self.file, 'POSIX_FADV_DONTNEED')
+        self.file.close()
+
+# str
+def get_request_operation(request):
+    query, headers = dict(request.query), dict(request.headers)
+    if query.get('comp') == 'list':
+        return 'list'
+    if 'x-ms-copy-source' in headers:
+        return 'copy'
+
+    operation = REQUEST_OPERATIONS.get(request.method, request.method.lower())
+    return u'{}_{}'.format(operation, query['comp']) if query.get('comp') else operation
+
+# str
+def get_request_blob(request):
+    parts = request.path.split('/', 2)
+    return parts[2] if len(parts) > 2 else None
+
+# str
+def get_request_range(request):
+    query, headers = dict(request.query), dict(request.headers)
+    if headers.get('x-ms-range'):
+        return headers['x-ms-range']
+
+    # Block ids are generated from the offset of the block in the file, quoted and
+    # encoded by the chunk uploader and encoded once more by `put_block`.
+    if query.get('comp') == 'block' and query.get('blockid'):
+        try:
+            offset = int(base64.b64decode(unquote(base64.b64decode(query['blockid']).decode('ascii'))))
+        except (TypeError, ValueError):
             return None
-        return base64.b64decode(self.blob.properties.content_settings.content_md5)
+        return u'bytes={}-{}'.format(offset, offset + len(request.body or b'') - 1)
+
+# contextmanager
+@contextlib.contextmanager
+def null_context():
+    yield
+
+# contextmanager
+@contextlib.contextmanager
+def profile(file_path=None):
+    if not file_path:
+        yield
+        return
+
+    # cProfile only sees the thread which enables it, so every thread started meanwhile (transfer workers,
+    # chunk executors) gets its own profiler and their stats are merged at the end.
+    profilers, lock = [], threading.Lock()
+
+    def profile_thread(*args):
+        # Only the hook of this thread is cleared, the threads started later still get theirs.
+        sys.setprofile(None)
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+ profiles every thread with the first profiler already.
+            return
+        with lock:
+            profilers.append(profiler)
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    threading.setprofile(profile_thread)
+    try:
+        yield
+    finally:
+        threading.setprofile(None)
+        profiler.disable()
+        stats = pstats.Stats(profiler)
+        with lock:
+            for thread_profiler in profilers:
+                thread_profiler.disable()
+                stats.add(thread_profiler)
+        stats.dump_stats(file_path)
+
+# tuple
+def get_request_key(request):
+    return (request.method, request.path, tuple(sorted((k, v) for k, v in request.query if v is not None)), \
+        dict(request.headers).get('x-ms-range'))
+
+# int
+def get_block_size(size, connections, minimum, maximum):
+    # Aim for a few blocks per connection, rounded down to whole megabytes.
+    block_size = size // (connections * 4) if size and connections > 1 else maximum
+    block_size -= block_size % (1024 * 1024)
+    return max(minimum, min(maximum, block_size))
+
+# int
+def parse_size(value):
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*$', u'{}'.format(value), re.IGNORECASE)
+    if not match:
+        raise InvalidLimit(u'Invalid size: `{}`. Expected format: `10M`, `512K`, `1G` or bytes.'.format(value))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+# tuple<int,int>
+def parse_range(value):
+    match = re.match(r'^\s*(\d+)\s*-\s*(\d*)\s*$', u'{}'.format(value))
+    if not match or (match.group(2) and int(match.group(2)) < int(match.group(1))):
+        raise InvalidLimit(u'Invalid range: `{}`. Expected format: `START-END` or `START-`.'.format(value))
+    return int(match.group(1)), int(match.group(2)) if match.group(2) else None
+
+# tuple<int,int>
+def get_byte_range(byte_range, size):
+    # Negative start counts from the end of the blob, missing end means the end of the blob.
+    start, end = byte_range
+    start = max(0, size + start) if start < 0 else start
+    end = size - 1 if end is None else min(end, size - 1)
+    return start, end
+
+# int
+def get_request_length(request):
+    range_header = dict(request.headers).get('x-ms-range')
+    if request.method == 'GET' and range_header:
+        start, end = range_header.split('=')[-1].split('-')
+        return int(end) - int(start) + 1
+    return len(request.body or b'')
+
+class LimitSchedule(object):
+    # void
+    def __init__(self, schedule):
+        self.windows = []
+        for window in schedule.split(','):
+            match = re.match(r'^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*$', window)
+            if not match:
+                raise InvalidLimit(u'Invalid schedule: `{}`. Expected format: `HH:MM-HH:MM[,HH:MM-HH:MM]`.'.format(window))
+            start_hour, start_minute, end_hour, end_minute = map(int, match.groups())
+            self.windows.append((start_hour * 60 + start_minute, end_hour * 60 + end_minute))
+
+    # bool
+    def is_active(self, now=None):
+        now = now or datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end in self.windows:
+            # Windows can go over midnight, eg. `22:00-06:00`.
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                return True
+        return False
+
+class TokenBucket(object):
+    # void
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.lock = threading.Lock()
+        self.next_free = time.time() - self.burst / self.rate
+
+    # float
+    def consume(self, amount):
+        if amount <= 0:
+            return 0.0
+
+        # Every caller reserves its slot in arrival order, so the waits are spread evenly between the workers.
+        with self.lock:
+            now = time.time()
+            self.next_free = max(self.next_free, now - self.burst / self.rate) + amount / self.rate
+            wait = self.next_free - now
+
+        if wait > 0:
+            time.sleep(wait)
+            return wait
+        return 0.0
+
+class RateLimiter(object):
+    # void
+    def __init__(self, max_bandwidth=None, max_requests_per_second=None, schedule=None):
+        self.bandwidth = TokenBucket(max_bandwidth) if max_bandwidth else None
+        self.requests = TokenBucket(max_requests_per_second, max(1.0, max_requests_per_second)) \
+            if max_requests_per_second else None
+        self.schedule = LimitSchedule(schedule) if schedule else None
+
+    # bool
+    def is_active(self):
+        return self.schedule is None or self.schedule.is_active()
+
+    # float
+    def before_request(self, request):
+        if not self.is_active():
+            return 0.0
+
+        waited = self.requests.consume(1) if self.requests is not None else 0.0
+        if self.bandwidth is not None:
+            waited += self.bandwidth.consume(get_request_length(request))
+        return waited
+
+    # float
+    def after_response(self, request, received):
+        if not self.is_active() or self.bandwidth is None:
+            return 0.0
+
+        # Responses bigger than the requested range (eg. non-ranged downloads) are paid afterwards.
+        expected = get_request_length(request) if request.method == 'GET' else 0
+        return self.bandwidth.consume(received - expected)
+
+class OutputProxy(object):
+    # Stands in for `sys.stdout` and `sys.stderr` in the daemon, every thread writes into the stream of its own job.
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    # file
+    def target(self):
+        return getattr(self.local, 'stream', None) or self.stream
 
-    @property
-    def path(self):
-        return self.blob.name
+    # void
+    def write(self, data):
+        self.target().write(data)
+
+    # void
+    def flush(self):
+        self.target().flush()
+
+    # object
+    def __getattr__(self, name):
+        return getattr(self.target(), name)
+
+# function
+def inherit_output(fn):
+    # The worker threads write into the same output as the thread which started them.
+    targets = [(proxy, proxy.target()) for proxy in (sys.stdout, sys.stderr) if isinstance(proxy, OutputProxy)]
+
+    def run(*args, **kwargs):
+        with redirect_output(targets):
+            return fn(*args, **kwargs)
+    return run
+
+# contextmanager
+@contextlib.contextmanager
+def redirect_output(targets):
+    previous = [(proxy, getattr(proxy.local, 'stream', None)) for proxy, stream in targets]
+    for proxy, stream in targets:
+        proxy.local.stream = stream
+    try:
+        yield
+    finally:
+        for proxy, stream in previous:
+            proxy.local.stream = stream
+
+class ConnectionBudget(object):
+    # void
+    def __init__(self, size):
+        self.size = max(1, size)
+        self.available = self.size
+        self.condition = threading.Condition()
+
+    # int
+    def acquire(self, wanted):
+        with self.condition:
+            while self.available < 1:
+                self.condition.wait()
+            granted = max(1, min(wanted, self.available))
+            self.available -= granted
+            return granted
+
+    # void
+    def release(self, count):
+        with self.condition:
+            self.available += count
+            self.condition.notify_all()
+
+class TransferScheduler(object):
+    # void
+    def __init__(self, budget, block_size=MAX_UPLOAD_BLOCK_SIZE, large_size=LARGE_FILE_SIZE):
+        self.budget = budget
+        self.block_size = block_size
+        self.large_size = large_size
+
+    # int
+    def get_connections(self, size, share):
+        # Unknown sizes are handled as large files.
+        if size is None:
+            return share
+        return max(1, min(share, size // self.block_size))
+
+    # void
+    def run(self, tasks):
+        # Sequential mode keeps the original order and streams the tasks.
+        if self.budget.size == 1:
+            for size, task_fn in tasks:
+                connections = self.budget.acquire(1)
+                try:
+                    task_fn(connections)
+                finally:
+                    self.budget.release(connections)
+            return
+
+        # Largest files first, so the run does not end with one huge file running alone.
+        tasks = sorted(tasks, key=lambda task: float('inf') if task[0] is None else task[0], reverse=True)
+        large = sum(1 for size, task_fn in tasks if size is None or size >= self.large_size)
+        share = max(1, self.budget.size // max(1, large))
+        tasks.reverse()
+        lock, errors = threading.Lock(), []
+
+        def worker():
+            while not errors:
+                with lock:
+                    if not tasks:
+                        return
+                    size, task_fn = tasks.pop()
+
+                connections = self.budget.acquire(self.get_connections(size, share))
+                try:
+                    task_fn(connections)
+                except BaseException as e:
+                    errors.append(e)
+                finally:
+                    self.budget.release(connections)
+
+        threads = [threading.Thread(target=inherit_output(worker)) for i in range(min(self.budget.size, len(tasks)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.1)
+
+        if errors:
+            raise errors[0]
+
+    # void
+    def stream(self, tasks):
+        # The tasks without meaningful sizes (eg. deletes) are not sorted, they go through a bounded queue
+        # in the original order, so the listing is never held in memory.
+        if self.budget.size == 1:
+            return self.run(tasks)
+
+        pending, errors = queue.Queue(self.budget.size * 2), []
+
+        def worker():
+            while True:
+                task = pending.get()
+                if task is None:
+                    return
+                # Drain the queue after a failure, so the producer is not blocked.
+                if errors:
+                    continue
+
+                size, task_fn = task
+                connections = self.budget.acquire(self.get_connections(size, self.budget.size))
+                try:
+                    task_fn(connections)
+                except BaseException as e:
+                    errors.append(e)
+                finally:
+                    self.budget.release(connections)
+
+        threads = [threading.Thread(target=inherit_output(worker)) for i in range(self.budget.size)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for task in tasks:
+                if errors:
+                    break
+                pending.put(task)
+        finally:
+            for thread in threads:
+                pending.put(None)
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.1)
+
+        if errors:
+            raise errors[0]
+
+class Histogram(object):
+    # void
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    # void
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    # dict
+    def as_dict(self):
+        cumulative, buckets = 0, []
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets.append(['+Inf' if bound == float('inf') else bound, cumulative])
+        return {'count': self.count, 'sum': self.sum, 'max': self.max, 'buckets': buckets}
+
+class Tracer(object):
+    # void
+    def __init__(self, file_path, format='chrome'):
+        self.lock = threading.Lock()
+        self.format = format
+        self.events = []
+        self.pid = os.getpid()
+        self.file = io.open(file_path, 'w', encoding='utf-8')
+
+    # void
+    def record(self, name, category, start, end, **kwargs):
+        event = {'name': name, 'cat': category, 'ph': 'X', 'pid': self.pid, 'tid': threading.current_thread().ident, \
+            'ts': int(start * 1000000), 'dur': int((end - start) * 1000000), 'args': kwargs}
+        with self.lock:
+            if self.format == 'jsonl':
+                self.file.write(u'{}\n'.format(json.dumps(event, sort_keys=True)))
+            else:
+                self.events.append(event)
+
+    # contextmanager
+    @contextlib.contextmanager
+    def span(self, name, category, **kwargs):
+        start, status = time.time(), 'ok'
+        try:
+            yield
+        except Exception:
+            status = 'fail'
+            raise
+        finally:
+            self.record(name, category, start, time.time(), status=status, **kwargs)
+
+    # void
+    def close(self):
+        with self.lock:
+            if self.format != 'jsonl':
+                self.file.write(u'{}'.format(json.dumps({'traceEvents': self.events, 'displayTimeUnit': 'ms'})))
+            self.file.close()
+
+class Stats(object):
+    # void
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.failed_requests = {}
+        self.started = time.time()
+
+    # void
+    def incr(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    # void
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    # contextmanager
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    # int
+    def attempt(self, key):
+        with self.lock:
+            retries = self.failed_requests.get(key, 0)
+        if retries:
+            self.incr('retries')
+        return retries
+
+    # void
+    def request(self, key, operation, status, elapsed, sent=0, received=0):
+        with self.lock:
+            if status is None or status >= 300:
+                self.failed_requests[key] = self.failed_requests.get(key, 0) + 1
+            else:
+                self.failed_requests.pop(key, None)
+
+        self.incr('requests', operation=operation, status=status or 'error')
+        self.observe('request_seconds', elapsed, operation=operation)
+        if sent:
+            self.incr('bytes_sent', sent, operation=operation)
+        if received:
+            self.incr('bytes_received', received, operation=operation)
+
+    # dict
+    def as_dict(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+
+        return {
+            'elapsed_seconds': time.time() - self.started,
+            'counters': [dict(name=name, labels=dict(labels), value=value) for (name, labels), value in counters],
+            'histograms': [dict(name=name, labels=dict(labels), **histogram.as_dict()) for (name, labels), histogram in histograms],
+        }
+
+    # str
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+    # str
+    def to_prometheus(self, namespace='azrcmd'):
+        def labels_repr(labels, **extra):
+            labels = sorted(list(labels.items()) + list(extra.items()))
+            return u'{%s}' % u','.join(u'{}="{}"'.format(k, v) for k, v in labels) if labels else u''
+
+        data, lines, seen = self.as_dict(), [], set()
+        lines.append(u'# TYPE {0}_elapsed_seconds gauge'.format(namespace))
+        lines.append(u'{0}_elapsed_seconds {1}'.format(namespace, data['elapsed_seconds']))
+        for counter in data['counters']:
+            name = u'{}_{}_total'.format(namespace, counter['name'])
+            if name not in seen:
+                lines.append(u'# TYPE {} counter'.format(name))
+                seen.add(name)
+            lines.append(u'{}{} {}'.format(name, labels_repr(counter['labels']), counter['value']))
+
+        for histogram in data['histograms']:
+            name = u'{}_{}'.format(namespace, histogram['name'])
+            if name not in seen:
+                lines.append(u'# TYPE {} histogram'.format(name))
+                seen.add(name)
+            for bound, count in histogram['buckets']:
+                lines.append(u'{}_bucket{} {}'.format(name, labels_repr(histogram['labels'], le=bound), count))
+            lines.append(u'{}_sum{} {}'.format(name, labels_repr(histogram['labels']), histogram['sum']))
+            lines.append(u'{}_count{} {}'.format(name, labels_repr(histogram['labels']), histogram['count']))
+
+        return u'\n'.join(lines) + u'\n'
+
+    # str
+    def summary(self):
+        data = self.as_dict()
+        lines = [u'Elapsed: {:.3f}s'.format(data['elapsed_seconds'])]
+        for histogram in data['histograms']:
+            labels = u' '.join(u'{}={}'.format(k, v) for k, v in sorted(histogram['labels'].items()))
+            lines.append(u'{:<40}count={:<8d} total={:.3f}s avg={:.3f}s max={:.3f}s'.format( \
+                (histogram['name'] + u' ' + labels).strip(), histogram['count'], histogram['sum'], \
+                histogram['sum'] / histogram['count'] if histogram['count'] else 0.0, histogram['max']))
+
+        for counter in data['counters']:
+            labels = u' '.join(u'{}={}'.format(k, v) for k, v in sorted(counter['labels'].items()))
+            lines.append(u'{:<40}{}'.format((counter['name'] + u' ' + labels).strip(), counter['value']))
+
+        return u'\n'.join(lines)
+
+    # void
+    def report(self, show=False, metrics_file=None, metrics_format='json'):
+        if show:
+            print(self.summary(), file=sys.stderr)
+
+        if metrics_file:
+            content = self.to_prometheus() if metrics_format == 'prometheus' else self.to_json()
+            with io.open(metrics_file, 'w', encoding='utf-8') as f:
+                f.write(u'{}'.format(content))
+
+class Blob(object):
+    __slots__ = ('path', 'content_length', 'last_modified', 'content_md5', 'etag', 'content_type', \
+        'content_encoding', 'metadata', 'url_prefix')
+
+    # void
+    def __init__(self, path, content_length=None, last_modified=None, content_md5=None, etag=None, \
+        content_type=None, content_encoding=None, metadata=None, url_prefix=u''):
+        self.path = path
+        self.content_length = content_length
+        self.last_modified = last_modified
+        self.content_md5 = content_md5
+        self.etag = etag
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+        self.metadata = metadata
+        self.url_prefix = url_prefix
+
+    # Blob
+    @classmethod
+    def from_sdk(cls, blob, url_prefix=u''):
+        properties = blob.properties
+        settings = properties.content_settings
+        return cls(blob.name, properties.content_length, properties.last_modified.replace(tzinfo=pytz.UTC), \
+            base64.b64decode(settings.content_md5) if settings.content_md5 else None, properties.etag, \
+            settings.content_type, settings.content_encoding, blob.metadata or None, url_prefix)
+
+    # list
+    def to_record(self):
+        return [self.content_length, calendar.timegm(self.last_modified.utctimetuple()) if self.last_modified else None, \
+            base64.b64encode(self.content_md5).decode('ascii') if self.content_md5 else None, self.etag, \
+            self.content_type, self.content_encoding, self.metadata]
+
+    # Blob
+    @classmethod
+    def from_record(cls, path, record, url_prefix=u''):
+        content_length, last_modified, content_md5, etag, content_type, content_encoding, metadata = record
+        return cls(path, content_length, \
+            datetime.datetime.fromtimestamp(last_modified, pytz.UTC) if last_modified is not None else None, \
+            base64.b64decode(content_md5) if content_md5 else None, etag, content_type, content_encoding, metadata, url_prefix)
 
     @property
     def url(self):
-        return os.path.join(self.service.url, self.path.strip('/'))
+        return self.url_prefix + self.path.strip('/')
 
     @property
     def repr_last_modified(self):
-        return self.last_modified.strftime('%Y-%m-%d %H:%M')
+        dt = self.last_modified
+        return u'%04d-%02d-%02d %02d:%02d' % (dt.year, dt.month, dt.day, dt.hour, dt.minute)
+
+class RecordWriter(object):
+    # void
+    def __init__(self, stream, format='text', fields=('name', 'size', 'last_modified'), time_format='iso', buffer_size=1024*1024):
+        self.stream = stream
+        self.format = format
+        self.fields = fields
+        self.time_format = time_format
+        self.buffer_size = buffer_size
+        self.buffer, self.buffered, self.count = [], 0, 0
+
+        if self.format in ('csv', 'tsv'):
+            self.write_line(self.join_row(self.fields))
+        elif self.format == 'json':
+            self.write_line(u'[', end=u'')
+
+    # str
+    def escape(self, value):
+        if value is None:
+            return u''
+        value = u'{}'.format(value)
+        if self.format == 'tsv':
+            return value.replace(u'\\', u'\\\\').replace(u'\t', u'\\t').replace(u'\n', u'\\n').replace(u'\r', u'\\r')
+        if any(c in value for c in u',"\r\n'):
+            return u'"{}"'.format(value.replace(u'"', u'""'))
+        return value
+
+    # str
+    def join_row(self, values):
+        return (u'\t' if self.format == 'tsv' else u',').join(map(self.escape, values))
+
+    # object
+    def get_value(self, blob, field):
+        if field == 'name':
+            return blob.path
+        if field == 'url':
+            return blob.url
+        if field == 'size':
+            return blob.content_length
+        if field == 'last_modified' and self.time_format == 'epoch':
+            return calendar.timegm(blob.last_modified.utctimetuple())
+        if field == 'last_modified':
+            return blob.last_modified.isoformat()
+        if field == 'md5':
+            return binascii.hexlify(blob.content_md5).decode('ascii') if blob.content_md5 else None
+        return getattr(blob, field)
+
+    # void
+    def write(self, blob):
+        if self.format == 'text':
+            line = u'%s\t%12d\t%s' % (blob.repr_last_modified, blob.content_length, blob.url)
+        elif self.format in ('csv', 'tsv'):
+            line = self.join_row([json.dumps(value, sort_keys=True) if isinstance(value, dict) else value \
+                for value in (self.get_value(blob, field) for field in self.fields)])
+        else:
+            line = json.dumps(dict((field, self.get_value(blob, field)) for field in self.fields), sort_keys=True)
+            if self.format == 'json':
+                line = (u',\n' if self.count else u'\n') + line
+
+        self.count += 1
+        self.write_line(line, end=u'' if self.format == 'json' else u'\n')
+
+    # void
+    def write_line(self, line, end=u'\n'):
+        self.buffer.append(line + end)
+        self.buffered += len(line) + len(end)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    # void
+    def flush(self):
+        self.stream.write(u''.join(self.buffer))
+        self.stream.flush()
+        self.buffer, self.buffered = [], 0
+
+    # void
+    def close(self):
+        if self.format == 'json':
+            self.write_line(u'\n]')
+        self.flush()
+
+class ListingCache(object):
+    # void
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    # list<Blob>
+    def get(self, key):
+        with self.lock:
+            created, blobs = self.entries.get(key, (0, None))
+            if time.time() - created > self.ttl:
+                self.entries.pop(key, None)
+                return None
+            return blobs
+
+    # void
+    def put(self, key, blobs):
+        with self.lock:
+            self.entries[key] = (time.time(), blobs)
+
+    # void
+    def invalidate(self, container):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == container]:
+                del self.entries[key]
+
+# void
+def clone_file(source_path, target_path, mode='copy'):
+    if mode == 'hardlink':
+        try:
+            return os.link(source_path, target_path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                raise
+
+    if mode in ('reflink', 'hardlink') and fcntl is not None:
+        with io.open(source_path, 'rb') as source, io.open(target_path, 'wb') as target:
+            try:
+                return fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+            except (IOError, OSError):
+                pass
+
+    # Different file systems or no copy-on-write support, the bytes are copied.
+    shutil.copyfile(source_path, target_path)
+
+# void
+def unlink_shared(file_path):
+    # A file with several hard links (eg. placed from the cache) is replaced, writing into it would change the other links.
+    try:
+        if os.stat(file_path).st_nlink > 1:
+            os.remove(file_path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+class BlobCache(object):
+    # void
+    def __init__(self, root, max_size, mode='reflink'):
+        self.root = root
+        self.max_size = max_size
+        self.mode = mode
+        self.size = None
+        for name in ('objects', 'tmp'):
+            if not os.path.isdir(os.path.join(root, name)):
+                try:
+                    os.makedirs(os.path.join(root, name))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+
+    # str
+    def get_key(self, account, container, blob, decompress=False):
+        # The MD5 hash or the ETag changes with every new content of the blob.
+        version = binascii.hexlify(blob.content_md5).decode('ascii') if blob.content_md5 else blob.etag
+        if not version:
+            return None
+        name = u'\n'.join([account, container, blob.path, version, u'decompressed' if decompress else u''])
+        return hashlib.sha256(name.encode('utf-8')).hexdigest()
+
+    # str
+    def get_entry_path(self, key):
+        return os.path.join(self.root, 'objects', key[:2], key)
+
+    # str
+    def get_temp_path(self, directory, key):
+        return os.path.join(directory, u'.{}.{}.{}.tmp'.format(key[:16], os.getpid(), threading.current_thread().ident))
+
+    # bool
+    def fetch(self, key, file_path):
+        entry_path = self.get_entry_path(key)
+        temp_path = self.get_temp_path(os.path.dirname(file_path), key)
+        try:
+            clone_file(entry_path, temp_path, self.mode)
+            os.rename(temp_path, file_path)
+        except (IOError, OSError) as e:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            # Evicted by somebody else in the meantime.
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+
+        self.touch(entry_path)
+        return True
+
+    # void
+    def touch(self, entry_path):
+        # The modification time is the last use of the entry. The hard linked entries share it with the downloaded
+        # files, so their last use is kept in a file next to them.
+        try:
+            if self.mode == 'hardlink':
+                used_path = entry_path + CACHE_USED_SUFFIX
+                io.open(used_path, 'ab').close()
+                os.utime(used_path, None)
+            else:
+                os.utime(entry_path, None)
+        except (IOError, OSError):
+            pass
+
+    # void
+    def store(self, key, file_path):
+        entry_path = self.get_entry_path(key)
+        if not os.path.isdir(os.path.dirname(entry_path)):
+            try:
+                os.makedirs(os.path.dirname(entry_path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        # The entries appear atomically, the concurrent processes either see the whole file or nothing.
+        temp_path = self.get_temp_path(os.path.join(self.root, 'tmp'), key)
+        try:
+            clone_file(file_path, temp_path, self.mode)
+            os.rename(temp_path, entry_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self.touch(entry_path)
+
+        size = os.path.getsize(entry_path)
+        if self.size is None or self.size + size > self.max_size:
+            self.evict()
+        else:
+            self.size += size
+
+    # contextmanager
+    @contextlib.contextmanager
+    def lock(self):
+        with io.open(os.path.join(self.root, 'lock'), 'ab') as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    # int
+    def evict(self):
+        # Only one process scans and evicts at a time, the least recently used entries go first.
+        with self.lock():
+            entries, used, objects = [], {}, os.path.join(self.root, 'objects')
+            for directory in os.listdir(objects):
+                for name in os.listdir(os.path.join(objects, directory)):
+                    path = os.path.join(objects, directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    if name.endswith(CACHE_USED_SUFFIX):
+                        used[path[:-len(CACHE_USED_SUFFIX)]] = stat.st_mtime
+                    else:
+                        entries.append((stat.st_mtime, stat.st_size, path))
+            entries = [(used.get(path, mtime), entry_size, path) for mtime, entry_size, path in entries]
+
+            size, evicted = sum(entry[1] for entry in entries), 0
+            for mtime, entry_size, path in sorted(entries):
+                if size <= self.max_size * CACHE_LOW_WATER:
+                    break
+                for entry_path in (path, path + CACHE_USED_SUFFIX):
+                    try:
+                        os.remove(entry_path)
+                    except OSError as e:
+                        if e.errno != errno.ENOENT:
+                            raise
+                size -= entry_size
+                evicted += 1
+            self.size = size
+            return evicted
+
+class DedupIndex(object):
+    # void
+    def __init__(self, manifest_path=None):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.manifest = None
+        if manifest_path:
+            self.load(manifest_path)
+            self.manifest = io.open(manifest_path, 'a', encoding='utf-8')
+
+    # void
+    def load(self, manifest_path):
+        if not os.path.exists(manifest_path):
+            return
+        with io.open(manifest_path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.entries[(base64.b64decode(entry['md5']), entry.get('encoding'))] = entry['url']
+
+    # void
+    def add_blobs(self, blobs):
+        for blob in blobs:
+            digest = get_raw_md5(blob)
+            if digest:
+                with self.lock:
+                    self.entries.setdefault((digest, blob.content_encoding), blob.url)
+
+    # str
+    def lookup(self, digest, encoding=None):
+        with self.lock:
+            return self.entries.get((digest, encoding))
+
+    # void
+    def add(self, digest, encoding, url):
+        with self.lock:
+            self.entries[(digest, encoding)] = url
+            if self.manifest is not None:
+                self.manifest.write(u'{}\n'.format(json.dumps({'md5': base64.b64encode(digest).decode('ascii'), \
+                    'encoding': encoding, 'url': url}, sort_keys=True)))
+                self.manifest.flush()
+
+    # void
+    def close(self):
+        if self.manifest is not None:
+            self.manifest.close()
+
+class Checkpoint(object):
+    # void
+    def __init__(self, file_path, container, prefix, interval=5.0):
+        self.file_path = file_path
+        self.container = container
+        self.prefix = prefix
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        # The listing continues from this marker, the already finished blobs after it are skipped.
+        self.marker = None
+        self.listed = False
+        self.finished = set()
+        self.completed = 0
+        # The failed blobs are retried first by the next run.
+        self.failed = collections.OrderedDict()
+        # The listed pages which are not finished yet, in the order of the listing: [marker, unfinished paths, finished paths].
+        # Only this window is saved, so the state does not grow with the size of the listing.
+        self.pages = collections.deque()
+        self.owners = {}
+        self.saved_at = time.time()
+        if os.path.exists(file_path):
+            self.load()
+
+    # void
+    def load(self):
+        with io.open(self.file_path, encoding='utf-8') as f:
+            state = json.load(f)
+        if (state.get('container'), state.get('prefix')) != (self.container, self.prefix):
+            raise InvalidCheckpoint(u'The checkpoint `{}` belongs to `{}/{}`!'.format( \
+                self.file_path, state.get('container'), state.get('prefix')))
+        self.marker, self.listed, self.completed = state['marker'], state['listed'], state['completed']
+        self.finished.update(state['finished'])
+        self.failed.update((path, record) for path, record in state['failed'])
+
+    # list<Blob>
+    def resumed_blobs(self, url_prefix=u''):
+        with self.lock:
+            return [Blob.from_record(path, record, url_prefix) for path, record in self.failed.items()]
+
+    # list<Blob>
+    def add_page(self, marker, blobs, next_marker):
+        with self.lock:
+            page, todo = [marker, set(), []], []
+            for blob in blobs:
+                if blob.path in self.finished:
+                    self.finished.discard(blob.path)
+                    page[2].append(blob.path)
+                # The failed blobs are already retried by resumed_blobs().
+                elif blob.path not in self.failed:
+                    page[1].add(blob.path)
+                    self.owners[blob.path] = page
+                    todo.append(blob)
+            self.pages.append(page)
+            self.marker, self.listed = next_marker or None, not next_marker
+            self.advance()
+        self.save(force=False)
+        return todo
+
+    # void
+    def advance(self):
+        while self.pages and not self.pages[0][1]:
+            self.pages.popleft()
+
+    # void
+    def complete(self, blob_path):
+        with self.lock:
+            page = self.owners.pop(blob_path, None)
+            if page is not None:
+                page[1].discard(blob_path)
+                page[2].append(blob_path)
+                self.advance()
+            elif self.failed.pop(blob_path, None) is None:
+                return
+            self.completed += 1
+        self.save(force=False)
+
+    # void
+    def fail(self, blob):
+        with self.lock:
+            page = self.owners.pop(blob.path, None)
+            if page is not None:
+                page[1].discard(blob.path)
+                self.advance()
+            self.failed[blob.path] = blob.to_record()
+        self.save(force=False)
+
+    # void
+    def save(self, force=True):
+        # The transfers do not wait for the disk, when another thread is saving the periodic save is skipped.
+        if not self.save_lock.acquire(force):
+            return
+        try:
+            with self.lock:
+                if not force and time.time() - self.saved_at < self.interval:
+                    return
+                self.saved_at = time.time()
+                state = dict(container=self.container, prefix=self.prefix, \
+                    marker=self.pages[0][0] if self.pages else self.marker, listed=self.listed and not self.pages, \
+                    completed=self.completed, finished=list(self.finished) + [path for page in self.pages for path in page[2]], \
+                    failed=list(self.failed.items()))
+            # Write a new file and rename it over the old one, so a crash leaves the last durable state.
+            temp_path = u'{}.tmp'.format(self.file_path)
+            with io.open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(u'{}'.format(json.dumps(state)))
+                f.flush()
+                os.fsync(f.fileno())
+            getattr(os, 'replace', os.rename)(temp_path, self.file_path)
+        finally:
+            self.save_lock.release()
+
+    # void
+    def close(self):
+        if self.listed and not self.pages and not self.failed:
+            if os.path.exists(self.file_path):
+                os.remove(self.file_path)
+        else:
+            self.save()
 
 class BlobStorage(object):
     # void
-    def __init__(self, wasbs_path, dryrun=False):
+    def __init__(self, wasbs_path, dryrun=False, stats=None, tracer=None, max_connections=None, limiter=None, \
+        compress=None, decompress=False, compress_workers=None, dedup_index=None, hash_workers=None, \
+        request_session=None, listing_cache=None):
         parsed = urlparse(wasbs_path)
         if parsed.scheme not in ('wasbs', 'wasb'):
             raise InvalidBlobStorePath('Remote path is not supported! Expected format: `wasb[s]://container/blob-path`')
@@ -142,9 +1407,42 @@ class BlobStorage(object):
 
         self.blob_path = self.blob_path or None
         self.pbar = None
+        self.concurrent = False
+        self.print_lock = threading.Lock()
+        self.budget = ConnectionBudget(max_connections or int(os.environ.get('AZURE_STORAGE_MAX_CONNECTIONS', 1)))
+        self.listed_blobs = {}
+        self.include_metadata = False
+        self.dedup_index = dedup_index
+        self.checkpoint = None
+        self.listing_cache = listing_cache
+        self.cache = None
+        self.account = os.environ['AZURE_STORAGE_ACCOUNT'].strip()
+        self.byte_range = None
+        self.range_headers = False
+        self.output = None
+        self.stdout_buffer_size = STDOUT_BUFFER_SIZE
+        self.compress = compress
+        self.decompress = decompress
+        self.compress_workers = compress_workers or multiprocessing.cpu_count()
+        # One compression pool is shared between the files in flight.
+        self.compress_executor = concurrent.futures.ThreadPoolExecutor(self.compress_workers) if compress else None
+        # hashlib releases the GIL, so the local files can be hashed in parallel.
+        self.hash_workers = hash_workers or 1
+        self.hash_executor = concurrent.futures.ThreadPoolExecutor(self.hash_workers) if self.hash_workers > 1 else None
+        self.digests = {}
+        self.stats = stats or Stats()
+        self.tracer = tracer
+        self.limiter = limiter
+        self.directories = set()
+        self.new_directories = set()
         self.service = BlockBlobService(
             account_name=os.environ['AZURE_STORAGE_ACCOUNT'].strip(), 
-            account_key=os.environ['AZURE_STORAGE_ACCESS_KEY'].strip())
+            account_key=os.environ['AZURE_STORAGE_ACCESS_KEY'].strip()) \
+            .with_filter(self.request_filter)
+        # `with_filter` deep copies the service, so the shared session (and its warm connections) is put back.
+        self.request_session = request_session
+        if request_session is not None:
+            self.service._httpclient.request_session = request_session
 
     @property
     def url(self):
@@ -156,40 +1454,178 @@ class BlobStorage(object):
 
     # Blob
     def get_blob(self):
-        for blob in self.list_blobs():
+        for blob in self.list_blobs(cached=True):
             if blob.path == self.blob_path:
                 return blob
 
+    # HTTPResponse
+    def request_filter(self, request, next_filter):
+        key, operation = get_request_key(request), get_request_operation(request)
+        retries = self.stats.attempt(key)
+        if self.limiter is not None:
+            self.stats.observe('throttle_seconds', self.limiter.before_request(request))
+
+        start, status, received = time.time(), None, 0
+        try:
+            response = next_filter(request)
+            status, received = response.status, len(response.body or b'')
+            if self.limiter is not None:
+                self.stats.observe('throttle_seconds', self.limiter.after_response(request, received))
+            return response
+        except Exception as e:
+            status = getattr(e, 'status', None)
+            raise
+        finally:
+            end = time.time()
+            self.stats.request(key, operation, status, end - start, \
+                sent=len(request.body or b''), received=received)
+            if self.tracer is not None:
+                self.tracer.record(operation, 'request', start, end, blob=get_request_blob(request), \
+                    range=get_request_range(request), status=status, retries=retries)
+
+    # genexp<list<Blob>>
+    def list_blobs(self, include_metadata=None, cached=False):
+        # Only the listings which are read whole anyway are cached, the transfers of `get` and `rm` stream
+        # the listing and work with the current versions of the blobs.
+        include_metadata = self.include_metadata if include_metadata is None else include_metadata
+        if self.listing_cache is None or not cached:
+            return self.list_remote_blobs(include_metadata)
+
+        key = (self.container, self.blob_path, bool(include_metadata))
+        blobs = self.listing_cache.get(key)
+        if blobs is None:
+            blobs = list(self.list_remote_blobs(include_metadata))
+            self.listing_cache.put(key, blobs)
+        else:
+            self.stats.incr('list_cache_hits')
+        return iter(blobs)
+
     # genexp<list<Blob>>
-    def list_blobs(self):
+    def list_remote_blobs(self, include_metadata):
+        checkpoint = self.checkpoint
+        url_prefix = self.url + u'/'
         marker = None
+        if checkpoint is not None:
+            # Retry the failed blobs of the previous run first, then continue the listing where it was left.
+            for blob in checkpoint.resumed_blobs(url_prefix):
+                self.stats.incr('resumed_blobs')
+                yield blob
+            if checkpoint.listed:
+                return
+            marker = checkpoint.marker
+
         while True:
-            batch = self.service.list_blobs(self.container, prefix=self.blob_path, marker=marker)
-            for blob in batch:
-                yield Blob(self, blob)
+            with self.stats.timer('list_page_seconds'):
+                batch = self.service.list_blobs(self.container, prefix=self.blob_path, marker=marker, \
+                    include=Include(metadata=True) if include_metadata else None)
+            self.stats.incr('list_pages')
+            blobs = [Blob.from_sdk(blob, url_prefix) for blob in batch]
+            if checkpoint is not None:
+                blobs = checkpoint.add_page(marker, blobs, batch.next_marker)
+            for blob in blobs:
+                self.stats.incr('list_blobs')
+                yield blob
             if not batch.next_marker:
                 break
             marker = batch.next_marker
 
+    # void
+    def complete(self, blob_path):
+        if self.checkpoint is not None:
+            self.checkpoint.complete(blob_path)
+            self.listed_blobs.pop(blob_path, None)
+
+    # bool
+    def finish(self, blob, ok):
+        if self.checkpoint is not None and not ok:
+            self.checkpoint.fail(blob)
+            self.listed_blobs.pop(blob.path, None)
+        elif ok:
+            self.complete(blob.path)
+        return ok
+
     # void
     def execute(self, executable_fn, message, end=None, **kwargs):
         # Print the original message
-        print(message % kwargs, end=end)
+        if not self.concurrent:
+            print(message % kwargs, end=end, file=self.output)
 
         # If dryrun, write the message and exit
         if self.dryrun:
-            print('IGNORE (--dryrun)')
-            return
+            return self.print_status(message % kwargs, end, 'IGNORE (--dryrun)')
 
+        operation = executable_fn.__name__.replace('_fn', '')
         try:
-            executable_fn(**kwargs)
-            print('OK')
+            with self.trace(operation, url=kwargs.get('url')), self.stats.timer('transfer_seconds', operation=operation):
+                status = executable_fn(**kwargs)
+            self.stats.incr('files', operation=operation, status='ok')
+            self.print_status(message % kwargs, end, status or 'OK')
+            return True
         except Exception as e:
-            print('FAIL\n{}'.format(e))
+            self.stats.incr('files', operation=operation, status='fail')
+            self.print_status(message % kwargs, end, 'FAIL\n{}'.format(e))
+            return False
 
     # void
-    def remove_fn(self, path, url=None):
-        self.service.delete_blob(self.container, path)
+    def print_status(self, message, end, status):
+        if not self.concurrent:
+            print(status, file=self.output)
+            return
+
+        # Concurrent transfers print the message and the status in one line.
+        with self.print_lock:
+            print(u'{}{}'.format(message, status if end == '' else u' ... ' + status), file=self.output)
+
+    # void
+    def run_tasks(self, tasks, sort=True):
+        if self.budget.size > 1 and not sort:
+            self.concurrent = True
+            return TransferScheduler(self.budget).stream(tasks)
+
+        if self.budget.size > 1:
+            tasks = list(tasks)
+            self.concurrent = len(tasks) > 1
+        TransferScheduler(self.budget).run(tasks)
+
+    # function
+    def get_progress_callback(self):
+        return None if self.concurrent else self.show_progress
+
+    # void
+    def finish_progress(self):
+        if self.pbar is not None:
+            self.pbar.finish()
+            self.pbar = None
+
+    # BlockBlobService
+    def get_service(self, size=None, connections=1):
+        if connections <= 1 or size is None:
+            return self.service
+
+        # Tune the block sizes for this file on a shallow copy, the connection pool is shared.
+        service = copy.copy(self.service)
+        service.MAX_BLOCK_SIZE = get_block_size(size, connections, MIN_UPLOAD_BLOCK_SIZE, MAX_UPLOAD_BLOCK_SIZE)
+        service.MAX_SINGLE_PUT_SIZE = min(self.service.MAX_SINGLE_PUT_SIZE, service.MAX_BLOCK_SIZE * connections)
+        service.MAX_CHUNK_GET_SIZE = get_block_size(size, connections, MIN_DOWNLOAD_CHUNK_SIZE, MAX_DOWNLOAD_CHUNK_SIZE)
+        service.MAX_SINGLE_GET_SIZE = min(self.service.MAX_SINGLE_GET_SIZE, service.MAX_CHUNK_GET_SIZE * 2)
+        return service
+
+    # contextmanager
+    def trace(self, name, **kwargs):
+        if self.tracer is None:
+            return null_context()
+        return self.tracer.span(name, 'transfer', **kwargs)
+
+    # void
+    def remove_fn(self, path, url=None, **kwargs):
+        try:
+            self.service.delete_blob(self.container, path)
+        except AzureMissingResourceHttpError:
+            # A resumed run lists again the blobs which were deleted right before the interruption.
+            if self.checkpoint is None:
+                raise
+            self.stats.incr('missing_blobs')
+            return 'OK (already deleted)'
 
     # void
     def remove_blobs(self, prefix=False):
@@ -200,16 +1636,122 @@ class BlobStorage(object):
         if not prefix:
             return self.execute(self.remove_fn, 'Remove blob from `%(url)s` ... ', path=self.blob_path, url=self.path, end='')
 
-        for blob in self.list_blobs():
-            self.execute(self.remove_fn, 'Remove blob from `%(url)s` ... ', path=blob.path, url=blob.url, end='')
+        def remove_task(blob):
+            return 0, lambda connections: self.finish(blob, self.execute(self.remove_fn, 'Remove blob from `%(url)s` ... ', \
+                path=blob.path, url=blob.url, end=''))
+
+        # Every delete costs the same, so they are streamed in the listing order.
+        self.run_tasks((remove_task(blob) for blob in self.list_blobs()), sort=False)
+
+    # str
+    def upload_fn(self, blob_path, file_path, rel_file_path=None, url=None, size=None, connections=1):
+        digest = None
+        if self.dedup_index is not None:
+            digest = self.get_digest(file_path)
+            source = self.dedup_index.lookup(digest, self.compress)
+            status = self.copy_fn(source, blob_path, digest, size) if source is not None else None
+            if status is not None:
+                return status
+
+        if self.compress:
+            self.upload_compressed(self.get_service(size, connections), blob_path, file_path, connections)
+        else:
+            with open_sequential(file_path) as f:
+                self.get_service(size, connections).create_blob_from_stream(self.container, blob_path, f, \
+                    count=os.path.getsize(file_path) if size is None else size, \
+                    content_settings=ContentSettings(content_md5=base64.b64encode(digest).decode('ascii')) if digest else None, \
+                    max_connections=connections, progress_callback=self.get_progress_callback())
+            self.finish_progress()
+
+        if digest is not None:
+            self.dedup_index.add(digest, self.compress, u'{}/{}'.format(self.url, blob_path))
+
+    # byte
+    def get_digest(self, file_path):
+        future = self.digests.pop(file_path, None)
+        return future.result() if future is not None else md5(file_path, stats=self.stats)
+
+    # str
+    def copy_fn(self, source, blob_path, digest, size=None):
+        # The index (especially a manifest) can be stale, the source is checked before it is used.
+        source_container, source_path = urlparse(source).netloc, urlparse(source).path.lstrip('/')
+        try:
+            blob = Blob.from_sdk(self.service.get_blob_properties(source_container, source_path))
+        except AzureMissingResourceHttpError:
+            blob = None
+        if blob is None or get_raw_md5(blob) != digest or blob.content_encoding != self.compress:
+            self.stats.incr('dedup_stale')
+            return None
+
+        if source == u'{}/{}'.format(self.url, blob_path):
+            self.stats.incr('dedup_unchanged')
+            return 'OK (unchanged)'
+
+        try:
+            copy = self.service.copy_blob(self.container, blob_path, self.service.make_blob_url(source_container, source_path), \
+                source_if_match=blob.etag)
+            while copy.status == 'pending':
+                time.sleep(COPY_POLL_INTERVAL)
+                copy = self.service.get_blob_properties(self.container, blob_path).properties.copy
+        except AzureHttpError:
+            copy = None
+        # Changed meanwhile or failed, the file is uploaded instead.
+        if copy is None or copy.status != 'success':
+            self.stats.incr('dedup_stale')
+            return None
+
+        self.stats.incr('dedup_copies')
+        self.stats.incr('dedup_bytes', size or 0)
+        return u'OK (copied from `{}`)'.format(source)
 
     # void
-    def upload_fn(self, blob_path, file_path, rel_file_path=None, url=None):
-        self.service.create_blob_from_path(self.container, blob_path, file_path, \
-            max_connections=int(os.environ.get('AZURE_STORAGE_MAX_CONNECTIONS',1)), \
-            progress_callback=self.show_progress)
-        self.pbar.finish()
-        self.pbar = None
+    def upload_compressed(self, service, blob_path, file_path, connections=1):
+        reader = CompressingReader(file_path, self.compress, self.compress_executor, self.compress_workers)
+        try:
+            self.put_stream(service, blob_path, reader, connections, \
+                ContentSettings(content_type=mimetypes.guess_type(file_path)[0], content_encoding=self.compress), \
+                reader.get_metadata)
+        finally:
+            reader.close()
+
+        self.stats.incr('compressed_input_bytes', reader.length)
+
+    # void
+    def put_stream(self, service, blob_path, stream, connections=1, content_settings=None, metadata_fn=dict):
+        block_size = service.MAX_BLOCK_SIZE
+        first = stream.read(block_size)
+        second = stream.read(block_size)
+
+        # Small contents are uploaded with a single request.
+        if not second:
+            service.create_blob_from_bytes(self.container, blob_path, first, \
+                content_settings=content_settings, metadata=metadata_fn())
+            return
+
+        def put_block(block):
+            offset, data = block
+            # Same block ids as the chunk uploader of the SDK.
+            block_id = quote(base64.b64encode('{0:032d}'.format(offset).encode('ascii')).decode('ascii'))
+            service.put_block(self.container, blob_path, data, block_id)
+            return BlobBlock(id=block_id)
+
+        def get_blocks():
+            offset = 0
+            for data in [first, second]:
+                yield offset, data
+                offset += len(data)
+            for data in iter(lambda: stream.read(block_size), b''):
+                yield offset, data
+                offset += len(data)
+
+        executor = concurrent.futures.ThreadPoolExecutor(max(1, connections))
+        try:
+            block_list = list(ordered_map(executor, put_block, get_blocks(), max(2, connections * 2)))
+        finally:
+            executor.shutdown()
+
+        service.put_block_list(self.container, blob_path, block_list, \
+            content_settings=content_settings, metadata=metadata_fn())
 
     # tuple<str,str>
     def get_upload_path_pair(self, file_path, common_prefix=None):
@@ -244,10 +1786,33 @@ class BlobStorage(object):
 
     # void
     def upload_blobs(self, file_paths):
-        for file_path, blob_path in self.get_upload_path_pairs(file_paths):
-            self.execute(self.upload_fn, 'Upload `%(rel_file_path)s` into `%(url)s`', \
+        def upload_task(file_path, blob_path):
+            size = os.path.getsize(file_path)
+            self.stats.incr('stat_calls')
+            # Hash ahead of the transfers when the hashes are needed for the deduplication.
+            if self.dedup_index is not None and self.hash_executor is not None:
+                self.digests[file_path] = self.hash_executor.submit(md5, file_path, self.stats)
+            return size, lambda connections: self.execute(self.upload_fn, 'Upload `%(rel_file_path)s` into `%(url)s`', \
                 file_path=file_path, rel_file_path=os.path.relpath(file_path), blob_path=blob_path, \
-                url=u'{}/{}'.format(self.url, blob_path))
+                url=u'{}/{}'.format(self.url, blob_path), size=size, connections=connections)
+
+        self.run_tasks(upload_task(file_path, blob_path) for file_path, blob_path in self.get_upload_path_pairs(file_paths))
+
+        if self.dedup_index is not None:
+            counters = dict((c['name'], c['value']) for c in self.stats.as_dict()['counters'] if not c['labels'])
+            print(u'Reused {} blobs ({} bytes) with server-side copies, {} blobs were unchanged.'.format( \
+                counters.get('dedup_copies', 0), counters.get('dedup_bytes', 0), counters.get('dedup_unchanged', 0)))
+
+    # DedupIndex
+    def build_dedup_index(self, sources=None, manifest_path=None):
+        index = DedupIndex(manifest_path)
+        with self.stats.timer('dedup_index_seconds'):
+            for source in sources or []:
+                # The source listings share the connections, limits and cached listings of this command.
+                storage = BlobStorage(source, stats=self.stats, tracer=self.tracer, limiter=self.limiter, \
+                    request_session=self.request_session, listing_cache=self.listing_cache)
+                index.add_blobs(storage.list_blobs(include_metadata=True, cached=True))
+        return index
 
     # void
     def show_progress(self, current, total):
@@ -269,23 +1834,157 @@ class BlobStorage(object):
                     FileTransferSpeed(),
                     ' '*5
                 ], 
-                maxval=total
+                maxval=total,
+                fd=sys.stderr
             ).start()
 
         self.pbar.update(current)
 
+    # str
+    def download_fn(self, blob_path, file_path, size=None, connections=1, **kwargs):
+        try:
+            return self.fetch_blob(blob_path, file_path, size, connections)
+        except AzureMissingResourceHttpError:
+            # The blob was deleted since it was listed (or saved into the checkpoint).
+            if self.checkpoint is None:
+                raise
+            self.stats.incr('missing_blobs')
+            return 'SKIP (deleted)'
+
+    # str
+    def fetch_blob(self, blob_path, file_path, size=None, connections=1):
+        if file_path != STDOUT_PATH:
+            unlink_shared(file_path)
+        if self.byte_range is not None:
+            if size is None:
+                size = self.service.get_blob_properties(self.container, blob_path).properties.content_length
+            start, end = get_byte_range(self.byte_range, size)
+            return self.download_range(self.get_service(end - start + 1, connections), blob_path, file_path, \
+                start, end, connections)
+
+        if self.cache is None:
+            return self.download_blob(blob_path, file_path, size, connections)
+
+        # A properties request instead of the transfer when the same version of the blob was downloaded before.
+        blob = self.listed_blobs.get(blob_path)
+        if blob is None:
+            blob = self.listed_blobs[blob_path] = Blob.from_sdk(self.service.get_blob_properties(self.container, blob_path))
+        key = self.cache.get_key(self.account, self.container, blob, self.decompress)
+        if key is not None and self.cache.fetch(key, file_path):
+            self.stats.incr('cache_hits')
+            self.stats.incr('cache_bytes', os.path.getsize(file_path))
+            return 'OK (cached)'
+
+        self.stats.incr('cache_misses')
+        self.download_blob(blob_path, file_path, blob.content_length, connections)
+        if key is not None:
+            self.cache.store(key, file_path)
+
     # void
-    def download_fn(self, blob_path, file_path, **kwargs):
-        self.service.get_blob_to_path(self.container, blob_path, file_path, \
-            max_connections=int(os.environ.get('AZURE_STORAGE_MAX_CONNECTIONS',1)), \
-            progress_callback=self.show_progress)
-        self.pbar.finish()
-        self.pbar = None
+    def download_blob(self, blob_path, file_path, size=None, connections=1):
+        if self.decompress:
+            blob = self.listed_blobs.get(blob_path)
+            encoding = blob.content_encoding if blob is not None else None
+            if blob is None:
+                properties = self.service.get_blob_properties(self.container, blob_path).properties
+                size, encoding = properties.content_length, properties.content_settings.content_encoding
+            if encoding in COMPRESSION_CODECS:
+                return self.download_decompressed(self.get_service(size, connections), blob_path, file_path, \
+                    size, encoding, connections)
+
+        self.get_service(size, connections).get_blob_to_path(self.container, blob_path, file_path, \
+            max_connections=connections, progress_callback=self.get_progress_callback())
+        self.finish_progress()
+
+    # void
+    def download_decompressed(self, service, blob_path, file_path, size, encoding, connections=1):
+        decompressor = Decompressor(encoding)
+        with io.open(file_path, 'wb') as f:
+            for data in self.get_range(service, blob_path, 0, size - 1, connections):
+                f.write(decompressor.decompress(data))
+
+    # genexp<byte>
+    def get_range(self, service, blob_path, start, end, connections=1):
+        chunk_size = service.MAX_CHUNK_GET_SIZE
+
+        def get_chunk(offset):
+            return service.get_blob_to_bytes(self.container, blob_path, \
+                start_range=offset, end_range=min(offset + chunk_size - 1, end)).content
+
+        # The chunks are downloaded in parallel and returned in order.
+        executor = concurrent.futures.ThreadPoolExecutor(max(1, connections))
+        try:
+            for data in ordered_map(executor, get_chunk, range(start, end + 1, chunk_size), max(2, connections * 2)):
+                yield data
+        finally:
+            executor.shutdown()
+
+    # void
+    def download_range(self, service, blob_path, file_path, start, end, connections=1):
+        chunks = self.get_range(service, blob_path, start, end, connections)
+        if file_path != STDOUT_PATH:
+            with io.open(file_path, 'wb') as f:
+                for data in chunks:
+                    f.write(data)
+        else:
+            # The slices of the concurrent downloads must not mix, a small slice is downloaded before taking the output,
+            # a larger one holds it until the end of its transfer. A single download is streamed right away.
+            buffered, buffered_size = [], 0
+            if self.concurrent:
+                for data in chunks:
+                    buffered.append(data)
+                    buffered_size += len(data)
+                    if buffered_size >= self.stdout_buffer_size:
+                        break
+            stream = getattr(sys.stdout, 'buffer', sys.stdout)
+            with self.print_lock:
+                if self.range_headers:
+                    stream.write(u'==> {}/{} <==\n'.format(self.url, blob_path).encode('utf-8'))
+                for data in itertools.chain(buffered, chunks):
+                    stream.write(data)
+                stream.flush()
+        self.stats.incr('range_bytes', max(0, end - start + 1))
+
+    # void
+    def make_directory(self, dir_path):
+        if not dir_path or dir_path in self.directories:
+            return
+
+        if not os.path.exists(dir_path):
+            self.stats.incr('mkdir_calls')
+            try:
+                os.makedirs(dir_path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            else:
+                self.new_directories.add(dir_path)
+
+        # The parents of an existing directory are existing too.
+        while dir_path and dir_path not in self.directories:
+            self.directories.add(dir_path)
+            dir_path = os.path.dirname(dir_path)
+
+    # void
+    def make_directories(self, dir_paths):
+        # Deepest first, so the parents are already in the cache when we get there.
+        for dir_path in sorted(set(dir_paths), key=lambda dir_path: -dir_path.count(os.sep)):
+            self.make_directory(dir_path)
+
+    # bool
+    def path_exists(self, file_path):
+        # Nothing can be inside a directory that was just created by us.
+        if os.path.dirname(file_path) in self.new_directories:
+            return False
+        return os.path.exists(file_path)
 
     # tuple<str,str>
-    def get_download_path_pair(self, blob_path, file_path, common_prefix=None):
+    def get_download_path_pair(self, blob_path, file_path, common_prefix=None, make_dirs=True):
+        if file_path == STDOUT_PATH:
+            return blob_path, file_path
+
         file_path = os.path.join(file_path, os.path.split(blob_path)[-1]) \
-            if os.path.exists(file_path) and os.path.isdir(file_path) and common_prefix is None \
+            if common_prefix is None and os.path.exists(file_path) and os.path.isdir(file_path) \
             else file_path
 
         if common_prefix:
@@ -293,14 +1992,13 @@ class BlobStorage(object):
         elif common_prefix == u'':
             file_path = os.path.join(file_path, blob_path.strip('/'))
 
-        dir_path = os.path.split(file_path)[0]
-        if dir_path and not os.path.exists(dir_path):
-            os.makedirs(dir_path)
+        if make_dirs:
+            self.make_directory(os.path.split(file_path)[0])
 
         return blob_path, file_path
 
     # genexp<tuple<str,str>>
-    def get_download_path_pairs(self, file_path, prefix=False, skip_existing=False, sync=False):
+    def get_download_path_pairs(self, file_path, prefix=False, skip_existing=False, sync=False, make_dirs=True):
         # Ignore if no blob path is defined.
         if not self.blob_path:
             raise BlobPathRequired(u'Blob path is required for `get` command.')
@@ -313,105 +2011,520 @@ class BlobStorage(object):
 
             # Only downloads the not existing or the updated files (based on file size).
             if sync and os.path.exists(file_path):
+                self.include_metadata = self.include_metadata or self.decompress
                 blob = self.get_blob()
-                if blob and get_fresher(blob, file_path) != blob:
+                if blob and get_fresher(blob, file_path, stats=self.stats, raw=self.decompress) != blob:
                     return
 
             # Return the caluclated path of the file.
-            yield self.get_download_path_pair(self.blob_path, file_path)
+            yield self.get_download_path_pair(self.blob_path, file_path, make_dirs=make_dirs)
             return
 
+        # The compressed blobs keep the size and hash of the original file in the metadata.
+        self.include_metadata = self.include_metadata or (sync and self.decompress)
+
         # List the blobs with the given prefix in the ABS.
-        blob_paths, blob_paths_dict = [], {}
-        for blob in self.list_blobs():
-            blob_paths.append(blob.path)
-            blob_paths_dict[blob.path] = blob
+        if self.checkpoint is None:
+            blob_paths, blob_paths_dict = [], {}
+            with self.stats.timer('list_seconds'):
+                for blob in self.list_blobs():
+                    if blob.path in blob_paths_dict:
+                        continue
+                    blob_paths.append(blob.path)
+                    blob_paths_dict[blob.path] = blob
+            self.listed_blobs = blob_paths_dict
+        else:
+            # The listing is streamed into the transfers, so only the pages in flight are kept in memory.
+            blob_paths = self.stream_listed_blobs()
 
         # Determine the common prefix between the blobs.
         common_prefix = os.path.dirname(self.blob_path) \
             if not self.blob_path.endswith('/') \
             else self.blob_path
-        resolved_file_paths = []
+        resolved_file_paths = set()
 
-        for blob_path in blob_paths:
+        def plan(blob_path):
             # Determine the input, output path pairs.
-            bp, fp = self.get_download_path_pair(blob_path, file_path, common_prefix=common_prefix)
-
+            bp, fp = self.get_download_path_pair(blob_path, file_path, common_prefix=common_prefix, make_dirs=make_dirs)
+            return blob_path, bp, fp, (skip_existing or sync) and self.path_exists(fp)
+
+        def check(planned):
+            # Ignore the files that already exists or only downloads the not existing or the updated files (based on file size).
+            blob_path, bp, fp, exists = planned
+            blob = self.listed_blobs[blob_path]
+            return blob_path, bp, fp, exists and (skip_existing or get_fresher(blob, fp, stats=self.stats, raw=self.decompress) != blob)
+
+        planned = (plan(blob_path) for blob_path in blob_paths)
+        if sync and self.hash_executor is not None:
+            checked = ordered_map(self.hash_executor, check, planned, self.hash_workers * 4)
+        else:
+            checked = (check(item) for item in planned)
+
+        for blob_path, bp, fp, skip in checked:
             # If any of the files want to write to the same file, raise an error.
-            if fp in resolved_file_paths:
+            if fp in resolved_file_paths and fp != STDOUT_PATH:
                 raise DirectoryRequired('Can not use the same path (`{}`) for multiple blob!' \
                     .format(fp))
 
-            # Ignore the files that already exists.
-            if skip_existing and os.path.exists(fp):
-                continue
-
-            # Only downloads the not existing or the updated files (based on file size).
-            if sync and os.path.exists(fp) and get_fresher(blob_paths_dict[blob_path], fp) != blob_paths_dict[blob_path]:
+            if skip:
+                self.complete(blob_path)
                 continue
 
-            resolved_file_paths.append(fp)
+            resolved_file_paths.add(fp)
             yield bp, fp
 
+    # genexp<str>
+    def stream_listed_blobs(self):
+        for blob in self.list_blobs():
+            self.listed_blobs[blob.path] = blob
+            yield blob.path
+
     # void
-    def download_blobs(self, file_path, prefix=False, skip_existing=False, sync=False):
-        # Iterates over the final input, output paths and download them.
-        for blob_path, file_path in self.get_download_path_pairs(file_path, prefix=prefix, skip_existing=skip_existing, sync=sync):
-            self.execute(self.download_fn, 'Download `%(url)s` into `%(rel_file_path)s`', \
-                blob_path=blob_path, file_path=file_path, rel_file_path=os.path.relpath(file_path), \
-                url=u'{}/{}'.format(self.url, blob_path))
+    def download_blobs(self, file_path, prefix=False, skip_existing=False, sync=False, precreate_dirs=False):
+        pairs = self.get_download_path_pairs(file_path, prefix=prefix, skip_existing=skip_existing, sync=sync, \
+            make_dirs=not precreate_dirs)
+
+        # Plan everything first and create the directory skeleton in one pass.
+        if precreate_dirs:
+            with self.stats.timer('plan_seconds'):
+                pairs = list(pairs)
+            with self.stats.timer('mkdir_seconds'):
+                self.make_directories(os.path.split(fp)[0] for bp, fp in pairs)
+
+        def download_task(blob_path, file_path):
+            blob = self.listed_blobs.get(blob_path)
+            size = blob.content_length if blob is not None else None
+            length = size
+            # The slices are scheduled by their own length.
+            if size is not None and self.byte_range is not None:
+                start, end = get_byte_range(self.byte_range, size)
+                length = max(0, end - start + 1)
+            return length, lambda connections: self.finish(blob or Blob(blob_path), self.execute(self.download_fn, \
+                'Download `%(url)s` into `%(rel_file_path)s`', blob_path=blob_path, file_path=file_path, \
+                rel_file_path=os.path.relpath(file_path), url=u'{}/{}'.format(self.url, blob_path), size=size, connections=connections))
+
+        # Iterates over the final input, output paths and download them. The checkpointed downloads are streamed in the
+        # listing order instead of the largest first, so the saved window stays small.
+        self.run_tasks((download_task(blob_path, file_path) for blob_path, file_path in pairs), sort=self.checkpoint is None)
 
 # void
-def ls(args=sys.argv[1:]):
+def add_common_arguments(parser):
+    parser.add_argument('--stats', help='print the per-phase timings and counters at the end.', action='store_true')
+    parser.add_argument('--metrics-file', help='write the collected metrics into this file.')
+    parser.add_argument('--metrics-format', help='format of the metrics file.', choices=['json', 'prometheus'], default='json')
+    parser.add_argument('--profile', help='run the command under cProfile and write the stats into this file.')
+    parser.add_argument('--trace', help='record every storage request into this file.')
+    parser.add_argument('--trace-format', help='format of the trace file.', choices=['chrome', 'jsonl'], default='chrome')
+    parser.add_argument('--daemon', help='run the command in the `azrcmd-daemon` listening on this socket (default: $AZRCMD_DAEMON).', \
+        default=os.environ.get('AZRCMD_DAEMON'))
+
+# void
+def add_transfer_arguments(parser):
+    parser.add_argument('--max-connections', help='number of connections shared between the transfers (default: $AZURE_STORAGE_MAX_CONNECTIONS).', type=int)
+    parser.add_argument('--max-bandwidth', help='maximum transfer rate in bytes per second (eg. 512K, 10M).', type=parse_size)
+    parser.add_argument('--max-requests-per-second', help='maximum number of storage requests per second.', type=float)
+    parser.add_argument('--limit-schedule', help='apply the limits only in these local time windows (eg. 08:00-20:00,22:00-23:00).')
+
+# void
+def add_checkpoint_arguments(parser):
+    parser.add_argument('--checkpoint', help='save the progress of the --prefix operation into this file and resume from it.')
+    parser.add_argument('--checkpoint-interval', help='seconds between the checkpoint saves (default: 5).', type=float, default=5.0)
+
+# contextmanager
+@contextlib.contextmanager
+def checkpoint(storage, args):
+    if not args.checkpoint or not args.prefix or args.dryrun:
+        yield
+        return
+
+    storage.checkpoint = Checkpoint(args.checkpoint, storage.container, storage.blob_path, args.checkpoint_interval)
+    try:
+        yield
+    finally:
+        storage.checkpoint.close()
+
+# RateLimiter
+def create_limiter(args):
+    if not any([getattr(args, 'max_bandwidth', None), getattr(args, 'max_requests_per_second', None)]):
+        return None
+    return RateLimiter(args.max_bandwidth, args.max_requests_per_second, args.limit_schedule)
+
+# BlobStorage
+def create_storage(args, dryrun=False, daemon=None):
+    storage = BlobStorage(args.wasbs_path, dryrun, max_connections=getattr(args, 'max_connections', None), \
+        limiter=create_limiter(args), compress=getattr(args, 'compress', None), decompress=getattr(args, 'decompress', False), \
+        compress_workers=getattr(args, 'compress_workers', None), hash_workers=getattr(args, 'hash_workers', None), \
+        request_session=daemon.session if daemon is not None else None, \
+        listing_cache=daemon.listing_cache if daemon is not None else None)
+    # The jobs of the daemon share its connections and limits.
+    if daemon is not None:
+        storage.budget = daemon.budget
+        storage.limiter = daemon.limiter or storage.limiter
+    if args.trace:
+        storage.tracer = Tracer(args.trace, args.trace_format)
+    return storage
+
+# void
+def report(storage, args):
+    storage.stats.report(args.stats, args.metrics_file, args.metrics_format)
+    if storage.tracer is not None:
+        storage.tracer.close()
+
+# list<str>
+def parse_fields(value):
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    if set(fields) - set(LIST_FIELDS):
+        raise argparse.ArgumentTypeError(u'unknown fields: {}'.format(', '.join(sorted(set(fields) - set(LIST_FIELDS)))))
+    return fields
+
+# str
+def get_absolute_path(path):
+    if path == STDOUT_PATH:
+        return path
+    # The trailing slash means "into this directory", so it is kept.
+    absolute = os.path.abspath(path)
+    return os.path.join(absolute, '') if path.endswith('/') else absolute
+
+# ArgumentParser
+def get_ls_parser():
     parser = argparse.ArgumentParser()
+    parser.add_argument('--format', help='output format.', choices=['text', 'json', 'jsonl', 'csv', 'tsv'], default='text')
+    parser.add_argument('--fields', help='comma separated list of the fields in the machine-readable formats: {}' \
+        .format(', '.join(LIST_FIELDS)), type=parse_fields, default='name,size,last_modified')
+    parser.add_argument('--time-format', help='format of the `last_modified` field.', choices=['iso', 'epoch'], default='iso')
+    add_common_arguments(parser)
     parser.add_argument('wasbs_path', help='remote path for Azure Blob Storage.')
-    args = parser.parse_args(args)
-    check_credentials()
-
-    storage = BlobStorage(args.wasbs_path)
-    for blob in storage.list_blobs():
-        print('%s\t%12d\t%s' % (blob.repr_last_modified, blob.content_length, blob.url))
+    return parser
 
 # void
-def rm(args=sys.argv[1:]):
+def run_ls(args, daemon=None):
+    fields = tuple(args.fields)
+    with profile(args.profile):
+        storage = create_storage(args, daemon=daemon)
+        writer = RecordWriter(sys.stdout, args.format, fields, args.time_format)
+        for blob in storage.list_blobs(include_metadata='metadata' in fields, cached=True):
+            writer.write(blob)
+        writer.close()
+        report(storage, args)
+
+# ArgumentParser
+def get_rm_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--prefix', help='download all blobs with prefix', action='store_true')
     parser.add_argument('--dryrun', help='just printing and not deleting.', action='store_true')
+    add_checkpoint_arguments(parser)
+    add_transfer_arguments(parser)
+    add_common_arguments(parser)
     parser.add_argument('wasbs_path', help='remote path for Azure Blob Storage.')
-    args = parser.parse_args(args)
-    check_credentials()
-
-    storage = BlobStorage(args.wasbs_path, args.dryrun)
-    storage.remove_blobs(args.prefix)
+    return parser
 
 # void
-def put(args=sys.argv[1:]):
+def run_rm(args, daemon=None):
+    with profile(args.profile):
+        storage = create_storage(args, args.dryrun, daemon)
+        with checkpoint(storage, args):
+            storage.remove_blobs(args.prefix)
+        report(storage, args)
+
+# ArgumentParser
+def get_put_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-R', '--recursive', help='upload directories recursively.', action='store_true')
+    parser.add_argument('--compress', help='compress the files and set the Content-Encoding of the blobs.', choices=COMPRESSION_CODECS)
+    parser.add_argument('--compress-workers', help='number of compression threads (default: number of CPUs).', type=int)
+    parser.add_argument('--dedup', help='copy the already uploaded files on the server side instead of uploading them again.', action='store_true')
+    parser.add_argument('--dedup-source', help='remote path to look for the already uploaded files (default: the destination container).', action='append')
+    parser.add_argument('--dedup-manifest', help='local manifest of the already uploaded files, updated with the uploads.')
+    parser.add_argument('--hash-workers', help='number of threads hashing the local files (default: 1).', type=int)
     parser.add_argument('--dryrun', help='just printing and not deleting.', action='store_true')
+    add_transfer_arguments(parser)
+    add_common_arguments(parser)
     parser.add_argument('file_path', nargs='+', help='local file or directory path.')
     parser.add_argument('wasbs_path', help='remote path for Azure Blob Storage.')
-    args = parser.parse_args(args)
-    check_credentials()
-
-    storage = BlobStorage(args.wasbs_path, args.dryrun)
-    paths = list(get_local_files(args.file_path, recursive=args.recursive))
-    storage.upload_blobs(paths)
+    return parser
 
 # void
-def get(args=sys.argv[1:]):
+def run_put(args, daemon=None):
+    with profile(args.profile):
+        storage = create_storage(args, args.dryrun, daemon)
+        with storage.stats.timer('walk_seconds'):
+            paths = list(get_local_files(args.file_path, recursive=args.recursive))
+        if args.dedup or args.dedup_source or args.dedup_manifest:
+            sources = args.dedup_source or ([storage.url] if args.dedup else [])
+            storage.dedup_index = storage.build_dedup_index(sources, args.dedup_manifest)
+        storage.upload_blobs(paths)
+        if storage.dedup_index is not None:
+            storage.dedup_index.close()
+        report(storage, args)
+
+# ArgumentParser
+def get_get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--prefix', help='download all blobs with prefix', action='store_true')
     parser.add_argument('--dryrun', help='just printing and not deleting.', action='store_true')
     parser.add_argument('--skip_existing', help='skip the already existing files', action='store_true')
     parser.add_argument('--sync', help='download only the newer/changed files', action='store_true')
+    parser.add_argument('--decompress', help='decompress the gzip/zstd encoded blobs while downloading', action='store_true')
+    parser.add_argument('--precreate-dirs', help='create the directory tree before downloading the files', action='store_true')
+    parser.add_argument('--hash-workers', help='number of threads hashing the local files for --sync (default: 1).', type=int)
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--range', help='download only these bytes of the blobs (eg. 0-1023, 4096-).', type=parse_range)
+    group.add_argument('--head', help='download only the first N bytes of the blobs (eg. 64K).', type=parse_size)
+    group.add_argument('--tail', help='download only the last N bytes of the blobs (eg. 1M).', type=parse_size)
+    parser.add_argument('--cache-dir', help='keep the downloaded blobs in this directory for the next downloads (default: $AZRCMD_CACHE_DIR).', \
+        default=os.environ.get('AZRCMD_CACHE_DIR'))
+    parser.add_argument('--cache-size', help='maximum size of the cache directory (default: 10G).', type=parse_size, default='10G')
+    parser.add_argument('--cache-mode', help='how the cached files are placed at the destination (default: reflink).', \
+        choices=CACHE_MODES, default='reflink')
+    add_checkpoint_arguments(parser)
+    add_transfer_arguments(parser)
+    add_common_arguments(parser)
     parser.add_argument('wasbs_path', help='remote path for Azure Blob Storage.')
-    parser.add_argument('file_path', help='local file or directory path.')
-    args = parser.parse_args(args)
-    check_credentials()
+    parser.add_argument('file_path', help='local file or directory path, `-` writes to the standard output.')
+    return parser
+
+# tuple<int,int>
+def get_range_argument(args):
+    if args.range is not None:
+        return tuple(args.range)
+    if args.head is not None:
+        return 0, args.head - 1
+    if args.tail is not None:
+        return -args.tail, None
+    # The standard output is written with the ranged reads too.
+    if args.file_path == STDOUT_PATH:
+        return 0, None
+
+# void
+def run_get(args, daemon=None):
+    byte_range = get_range_argument(args)
+    if byte_range is not None and (args.decompress or args.sync):
+        raise NotSupported(u'Partial downloads and the standard output can not be used with `--decompress` or `--sync`.')
 
     if not os.path.exists(args.file_path) and args.file_path.endswith('/'):
         os.makedirs(args.file_path)
 
-    storage = BlobStorage(args.wasbs_path, args.dryrun)
-    storage.download_blobs(os.path.abspath(args.file_path), args.prefix, args.skip_existing, args.sync)
+    with profile(args.profile):
+        storage = create_storage(args, args.dryrun, daemon)
+        storage.byte_range = byte_range
+        if args.cache_dir:
+            storage.cache = BlobCache(args.cache_dir, args.cache_size, args.cache_mode)
+        file_path = os.path.abspath(args.file_path)
+        if args.file_path == STDOUT_PATH:
+            # Keep the standard output for the data.
+            storage.output, storage.range_headers, file_path = sys.stderr, args.prefix, STDOUT_PATH
+        with checkpoint(storage, args):
+            storage.download_blobs(file_path, args.prefix, args.skip_existing, args.sync, args.precreate_dirs)
+        report(storage, args)
+
+COMMANDS = {
+    'ls': (get_ls_parser, run_ls),
+    'rm': (get_rm_parser, run_rm),
+    'put': (get_put_parser, run_put),
+    'get': (get_get_parser, run_get),
+}
+
+# The arguments which are local paths, they are made absolute before the command is sent to the daemon.
+LOCAL_PATH_ARGUMENTS = ('file_path', 'metrics_file', 'profile', 'trace', 'checkpoint', 'dedup_manifest', 'cache_dir')
+
+# void
+def run_command(command, args):
+    get_parser, run = COMMANDS[command]
+    args = get_parser().parse_args(args)
+    if args.daemon:
+        sys.exit(forward(args.daemon, command, args))
+
+    check_credentials()
+    run(args)
+
+# void
+def ls(args=sys.argv[1:]):
+    run_command('ls', args)
+
+# void
+def rm(args=sys.argv[1:]):
+    run_command('rm', args)
+
+# void
+def put(args=sys.argv[1:]):
+    run_command('put', args)
+
+# void
+def get(args=sys.argv[1:]):
+    run_command('get', args)
+
+# int
+def forward(socket_path, command, args):
+    arguments = dict(vars(args), daemon=None)
+    for name in LOCAL_PATH_ARGUMENTS:
+        value = arguments.get(name)
+        if isinstance(value, list):
+            arguments[name] = [get_absolute_path(path) for path in value]
+        elif value:
+            arguments[name] = get_absolute_path(value)
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except socket.error as e:
+        connection.close()
+        print(u'Can not connect to the daemon on `{}` ({}). Start `azrcmd-daemon` or run the command without ' \
+            u'--daemon and $AZRCMD_DAEMON.'.format(socket_path, e), file=sys.stderr)
+        return 1
+
+    try:
+        stream = connection.makefile('rwb')
+        stream.write(json.dumps(dict(command=command, args=arguments)).encode('utf-8') + b'\n')
+        stream.flush()
+        for line in stream:
+            message = json.loads(line.decode('utf-8'))
+            if 'exit' in message:
+                return message['exit']
+            output = sys.stdout if message['stream'] == 'stdout' else sys.stderr
+            if message.get('binary'):
+                # The raw bytes (eg. the blob ranges written to `-`) bypass the text layer.
+                output.flush()
+                output = getattr(output, 'buffer', output)
+                output.write(base64.b64decode(message['data']))
+            else:
+                output.write(message['data'])
+            output.flush()
+    finally:
+        connection.close()
+
+    # The daemon went away in the middle of the command.
+    return 1
+
+class SocketOutput(object):
+    # void
+    def __init__(self, stream, name, lock):
+        self.stream = stream
+        self.name = name
+        self.lock = lock
+
+    # void
+    def write(self, data):
+        if not data:
+            return
+        # The bytes are sent in base64 frames, so the binary output reaches the client unchanged.
+        message = dict(stream=self.name, data=data)
+        if isinstance(data, bytes):
+            message.update(data=base64.b64encode(data).decode('ascii'), binary=True)
+        with self.lock:
+            self.stream.write(json.dumps(message).encode('utf-8') + b'\n')
+            self.stream.flush()
+
+    # void
+    def flush(self):
+        pass
+
+    # bool
+    def isatty(self):
+        return False
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    # void
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        request = json.loads(line.decode('utf-8'))
+        lock = threading.Lock()
+        code = self.server.daemon.run(request['command'], request['args'], \
+            SocketOutput(self.wfile, 'stdout', lock), SocketOutput(self.wfile, 'stderr', lock))
+        with lock:
+            self.wfile.write(json.dumps(dict(exit=code)).encode('utf-8') + b'\n')
+
+class Daemon(object):
+    # void
+    def __init__(self, socket_path, max_connections=None, limiter=None, list_cache_ttl=30):
+        self.socket_path = socket_path
+        self.budget = ConnectionBudget(max_connections or int(os.environ.get('AZURE_STORAGE_MAX_CONNECTIONS', 1)))
+        self.limiter = limiter
+        self.listing_cache = ListingCache(list_cache_ttl) if list_cache_ttl > 0 else None
+        # One connection pool for every job, big enough for the whole budget.
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(10, self.budget.size))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.server = None
+
+    # int
+    def run(self, command, args, stdout, stderr):
+        args = argparse.Namespace(**args)
+        targets = [(proxy, stream) for proxy, stream in ((sys.stdout, stdout), (sys.stderr, stderr)) if isinstance(proxy, OutputProxy)]
+        with redirect_output(targets):
+            # The profiler hooks every thread of the process, the jobs running meanwhile would be mixed into the dump.
+            if getattr(args, 'profile', None):
+                print(u'--profile is not supported in the daemon, run the command without --daemon and $AZRCMD_DAEMON.', \
+                    file=sys.stderr)
+                return 1
+            try:
+                COMMANDS[command][1](args, daemon=self)
+                return 0
+            except SystemExit as e:
+                return e.code if isinstance(e.code, int) else int(e.code is not None)
+            except Exception:
+                traceback.print_exc()
+                return 1
+            finally:
+                # Our own writes make the cached listings of the container stale.
+                if self.listing_cache is not None and command in ('put', 'rm'):
+                    self.listing_cache.invalidate(urlparse(args.wasbs_path).netloc)
+
+    # void
+    def start(self):
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+                raise DaemonIsRunning(u'A daemon is already listening on `{}`'.format(self.socket_path))
+            except socket.error:
+                os.remove(self.socket_path)
+            finally:
+                probe.close()
+
+        if not isinstance(sys.stdout, OutputProxy):
+            sys.stdout, sys.stderr = OutputProxy(sys.stdout), OutputProxy(sys.stderr)
+
+        # The socket is created with its final mode, other users can not connect before a chmod.
+        umask = os.umask(0o177)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, DaemonRequestHandler)
+        finally:
+            os.umask(umask)
+        self.server.daemon_threads = True
+        self.server.daemon = self
+
+    # void
+    def serve_forever(self):
+        try:
+            self.server.serve_forever()
+        finally:
+            self.close()
+
+    # void
+    def close(self):
+        self.server.server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+# void
+def daemon(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', help='path of the Unix socket (default: $AZRCMD_DAEMON).', default=os.environ.get('AZRCMD_DAEMON'))
+    parser.add_argument('--list-cache-ttl', help='seconds to keep the listings for the next commands, 0 turns it off (default: 30).', \
+        type=float, default=30)
+    add_transfer_arguments(parser)
+    args = parser.parse_args(args)
+    if not args.socket:
+        parser.error(u'the socket path is required (--socket or $AZRCMD_DAEMON)')
+    check_credentials()
+
+    server = Daemon(args.socket, args.max_connections, create_limiter(args), args.list_cache_ttl)
+    server.start()
+    print(u'Listening on `{}`'.format(args.socket))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -1,9 +1,15 @@
 import io
+import sys
+import json
+import argparse
+import base64
 import os
+import time
 import pytz
 import shutil
 import hashlib
 import datetime
+import threading
 import unittest
 from azrcmd import *
 
@@ -529,3 +535,1031 @@ class TestGetPaths(unittest.TestCase):
         self.assertEqual(len(res), 2)
         self.assertEqual(res[0], ('file-1.txt','directory/file-1.txt'))
         self.assertEqual(res[1], ('file-3.txt','directory/file-3.txt'))
+
+    def test_prefixed_multiple_file_into_directory_sync_with_hash_workers(self):
+        service = BlobStorage('wasbs://container/file.txt', hash_workers=3)
+        service.list_blobs = self._get_small_blob
+        self._touch('directory/file-1.txt',u'a')
+        self._touch('directory/file-2.txt',u'b')
+        res = list(service.get_download_path_pairs('directory/', prefix=True, sync=True))
+        self.assertEqual(res, [('file-3.txt','directory/file-3.txt')])
+
+class TestLocalReads(unittest.TestCase):
+    def tearDown(self):
+        if os.path.exists('large.bin'):
+            os.remove('large.bin')
+
+    def test_md5_of_multiple_buffers(self):
+        content = os.urandom(READ_BUFFER_SIZE * 2 + 123)
+        with io.open('large.bin', 'wb') as f:
+            f.write(content)
+        stats = Stats()
+        self.assertEqual(md5('large.bin', stats=stats), hashlib.md5(content).digest())
+        self.assertEqual(md5('large.bin'), hashlib.md5(content).digest())
+        self.assertEqual(stats.counters[('hash_bytes', ())], len(content))
+
+class TestStats(unittest.TestCase):
+    class Request(object):
+        def __init__(self, method, path, query=None, headers=None, body=b''):
+            self.method = method
+            self.path = path
+            self.query = query or []
+            self.headers = headers or []
+            self.body = body
+
+    class Response(object):
+        def __init__(self, status, body=b''):
+            self.status = status
+            self.body = body
+
+    class HTTPError(Exception):
+        def __init__(self, status):
+            self.status = status
+
+    def setUp(self):
+        os.environ['AZURE_STORAGE_ACCOUNT'] = 'account'
+        os.environ['AZURE_STORAGE_ACCESS_KEY'] = 'key'
+
+    def tearDown(self):
+        if os.path.exists('metrics.prom'):
+            os.remove('metrics.prom')
+
+    def test_request_operation(self):
+        self.assertEqual(get_request_operation(self.Request('GET', '/container', [('restype','container'),('comp','list')])), 'list')
+        self.assertEqual(get_request_operation(self.Request('GET', '/container/file.txt')), 'get')
+        self.assertEqual(get_request_operation(self.Request('PUT', '/container/file.txt', [('comp','block'),('blockid','MQ==')])), 'put_block')
+        self.assertEqual(get_request_operation(self.Request('PUT', '/container/file.txt', headers=[('x-ms-copy-source','url')])), 'copy')
+        self.assertEqual(get_request_operation(self.Request('DELETE', '/container/file.txt')), 'delete')
+
+    def test_request_filter_counts_bytes_and_retries(self):
+        service = BlobStorage('wasbs://container/file.txt')
+        request = self.Request('PUT', '/container/file.txt', [('comp','block'),('blockid','MQ==')], body=b'abc')
+
+        def failing(request):
+            raise self.HTTPError(503)
+
+        with self.assertRaises(self.HTTPError):
+            service.request_filter(request, failing)
+        service.request_filter(request, lambda request: self.Response(201))
+        service.request_filter(self.Request('GET', '/container/file.txt'), lambda request: self.Response(200, b'12345'))
+
+        counters = dict(((c['name'], tuple(sorted(c['labels'].items()))), c['value']) for c in service.stats.as_dict()['counters'])
+        self.assertEqual(counters[('retries', ())], 1)
+        self.assertEqual(counters[('requests', (('operation','put_block'),('status',503)))], 1)
+        self.assertEqual(counters[('requests', (('operation','put_block'),('status',201)))], 1)
+        self.assertEqual(counters[('bytes_sent', (('operation','put_block'),))], 6)
+        self.assertEqual(counters[('bytes_received', (('operation','get'),))], 5)
+
+    def test_hash_and_stat_metrics(self):
+        stats = Stats()
+        with io.open('metrics.prom', 'wb') as f:
+            f.write(b'a' * 10)
+        md5('metrics.prom', stats=stats)
+        counters = dict((c['name'], c['value']) for c in stats.as_dict()['counters'])
+        self.assertEqual(counters['hash_bytes'], 10)
+
+    def test_prometheus_export(self):
+        stats = Stats()
+        stats.incr('files', operation='download', status='ok')
+        stats.observe('request_seconds', 0.2, operation='get')
+        stats.report(metrics_file='metrics.prom', metrics_format='prometheus')
+        content = io.open('metrics.prom', encoding='utf-8').read()
+        self.assertIn(u'azrcmd_files_total{operation="download",status="ok"} 1', content)
+        self.assertIn(u'azrcmd_request_seconds_bucket{le="0.25",operation="get"} 1', content)
+        self.assertIn(u'azrcmd_request_seconds_count{operation="get"} 1', content)
+
+class TestTrace(unittest.TestCase):
+    Request = TestStats.Request
+    Response = TestStats.Response
+
+    def setUp(self):
+        os.environ['AZURE_STORAGE_ACCOUNT'] = 'account'
+        os.environ['AZURE_STORAGE_ACCESS_KEY'] = 'key'
+
+    def tearDown(self):
+        for file_name in ['trace.json', 'trace.jsonl', 'profile.out']:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+    def test_request_range(self):
+        block_id = base64.b64encode('{0:032d}'.format(4194304).encode('ascii')).decode('ascii').replace('=', '%3D')
+        block_id = base64.b64encode(block_id.encode('ascii')).decode('ascii')
+        request = self.Request('PUT', '/container/dir/file.txt', [('comp','block'),('blockid',block_id)], body=b'abcd')
+        self.assertEqual(get_request_blob(request), 'dir/file.txt')
+        self.assertEqual(get_request_range(request), 'bytes=4194304-4194307')
+        request = self.Request('GET', '/container/file.txt', headers=[('x-ms-range','bytes=0-99')])
+        self.assertEqual(get_request_range(request), 'bytes=0-99')
+
+    def test_jsonl_trace(self):
+        service = BlobStorage('wasbs://container/file.txt')
+        service.tracer = Tracer('trace.jsonl', 'jsonl')
+        service.request_filter(self.Request('GET', '/container/file.txt', headers=[('x-ms-range','bytes=0-99')]), \
+            lambda request: self.Response(206, b'x' * 100))
+        service.execute(lambda **kwargs: None, 'Nothing `%(url)s` ... ', url='wasbs://container/file.txt', end='')
+        service.tracer.close()
+
+        events = [json.loads(line) for line in io.open('trace.jsonl', encoding='utf-8')]
+        self.assertEqual(len(events), 2)
+        self.assertEqual(events[0]['name'], 'get')
+        self.assertEqual(events[0]['args'], {'blob': 'file.txt', 'range': 'bytes=0-99', 'status': 206, 'retries': 0})
+        self.assertEqual(events[1]['cat'], 'transfer')
+
+    def test_chrome_trace(self):
+        tracer = Tracer('trace.json')
+        tracer.record('delete', 'request', 1.0, 1.5, blob='file.txt')
+        tracer.close()
+        trace = json.load(io.open('trace.json', encoding='utf-8'))
+        self.assertEqual(trace['traceEvents'][0]['ts'], 1000000)
+        self.assertEqual(trace['traceEvents'][0]['dur'], 500000)
+
+    def test_profile(self):
+        with profile('profile.out'):
+            md5(__file__)
+        self.assertTrue(os.path.getsize('profile.out') > 0)
+
+    def test_profile_includes_the_worker_threads(self):
+        def first_worker():
+            md5(__file__)
+
+        def second_worker():
+            md5(__file__)
+
+        with profile('profile.out'):
+            # One after the other, so the first thread is done before the second one starts.
+            for worker in (first_worker, second_worker):
+                thread = threading.Thread(target=worker)
+                thread.start()
+                thread.join()
+            TransferScheduler(ConnectionBudget(2)).run([(1, lambda connections: first_worker()), (2, lambda connections: second_worker())])
+        import pstats
+        functions = [function for filename, line, function in pstats.Stats('profile.out').stats]
+        for function in ('first_worker', 'second_worker', 'md5'):
+            self.assertIn(function, functions)
+
+class TestListFormats(unittest.TestCase):
+    class Blob(object):
+        def __init__(self, path, content_length, metadata=None):
+            self.path = path
+            self.url = u'wasbs://container/' + path
+            self.content_length = content_length
+            self.last_modified = datetime.datetime(2016, 1, 2, 3, 4, 5, tzinfo=pytz.UTC)
+            self.content_md5 = hashlib.md5(b'a').digest()
+            self.etag = u'0x8D3'
+            self.content_type = u'text/plain'
+            self.content_encoding = None
+            self.metadata = metadata
+            self.repr_last_modified = u'2016-01-02 03:04'
+
+    def _write(self, format, fields=('name', 'size', 'last_modified'), time_format='iso', buffer_size=1024):
+        stream = io.StringIO()
+        writer = RecordWriter(stream, format, fields, time_format, buffer_size=buffer_size)
+        writer.write(self.Blob(u'dir/file-1.txt', 1))
+        writer.write(self.Blob(u'dir/file,2.txt', 22, metadata={u'k': u'v'}))
+        writer.close()
+        return stream.getvalue()
+
+    def test_text(self):
+        self.assertEqual(self._write('text').splitlines()[0], u'2016-01-02 03:04\t           1\twasbs://container/dir/file-1.txt')
+
+    def test_jsonl(self):
+        rows = [json.loads(line) for line in self._write('jsonl', ('name', 'last_modified', 'md5'), 'epoch').splitlines()]
+        self.assertEqual(rows[0], {u'name': u'dir/file-1.txt', u'last_modified': 1451703845, u'md5': hashlib.md5(b'a').hexdigest()})
+
+    def test_json(self):
+        rows = json.loads(self._write('json', ('name', 'size', 'metadata')))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1], {u'name': u'dir/file,2.txt', u'size': 22, u'metadata': {u'k': u'v'}})
+
+    def test_csv(self):
+        lines = self._write('csv', ('name', 'size', 'last_modified', 'metadata')).splitlines()
+        self.assertEqual(lines[0], u'name,size,last_modified,metadata')
+        self.assertEqual(lines[2], u'"dir/file,2.txt",22,2016-01-02T03:04:05+00:00,"{""k"": ""v""}"')
+
+    def test_tsv_is_buffered(self):
+        stream = io.StringIO()
+        writer = RecordWriter(stream, 'tsv', ('name', 'size'))
+        writer.write(self.Blob(u'file.txt', 1))
+        self.assertEqual(stream.getvalue(), u'')
+        writer.close()
+        self.assertEqual(stream.getvalue(), u'name\tsize\nfile.txt\t1\n')
+
+class TestBlob(unittest.TestCase):
+    def _sdk_blob(self):
+        from azure.storage.blob.models import Blob as SDKBlob
+        blob = SDKBlob(name=u'dir/file.txt', metadata={u'k': u'v'})
+        blob.properties.last_modified = datetime.datetime(2016, 1, 2, 3, 4, 5)
+        blob.properties.content_length = 11
+        blob.properties.etag = u'0x8D3'
+        blob.properties.content_settings.content_md5 = base64.b64encode(hashlib.md5(b'a').digest()).decode('ascii')
+        blob.properties.content_settings.content_type = u'text/plain'
+        return blob
+
+    def test_from_sdk(self):
+        blob = Blob.from_sdk(self._sdk_blob(), u'wasbs://container/')
+        self.assertEqual(blob.path, u'dir/file.txt')
+        self.assertEqual(blob.url, u'wasbs://container/dir/file.txt')
+        self.assertEqual(blob.content_length, 11)
+        self.assertEqual(blob.last_modified, datetime.datetime(2016, 1, 2, 3, 4, 5, tzinfo=pytz.UTC))
+        self.assertEqual(blob.content_md5, hashlib.md5(b'a').digest())
+        self.assertEqual(blob.metadata, {u'k': u'v'})
+        self.assertEqual(blob.repr_last_modified, u'2016-01-02 03:04')
+
+    def test_compact(self):
+        blob = Blob.from_sdk(self._sdk_blob())
+        self.assertFalse(hasattr(blob, '__dict__'))
+        self.assertEqual(blob.content_md5, Blob.from_sdk(self._sdk_blob()).content_md5)
+
+class TestDirectoryCache(unittest.TestCase):
+    Blob = TestGetPaths.Blob
+
+    def setUp(self):
+        os.environ['AZURE_STORAGE_ACCOUNT'] = 'account'
+        os.environ['AZURE_STORAGE_ACCESS_KEY'] = 'key'
+
+    def tearDown(self):
+        if os.path.exists('directory'):
+            shutil.rmtree('directory')
+
+    def _list_blobs(self):
+        return map(self.Blob, [u'dir1/file-%d.txt' % i for i in range(50)] + [u'dir1/subdir/file.txt', u'dir2/file.txt'])
+
+    def _counter(self, service, name):
+        return sum(c['value'] for c in service.stats.as_dict()['counters'] if c['name'] == name)
+
+    def test_directories_are_created_once(self):
+        service = BlobStorage('wasbs://container/dir')
+        service.list_blobs = self._list_blobs
+        res = list(service.get_download_path_pairs('directory', prefix=True, skip_existing=True))
+        self.assertEqual(len(res), 52)
+        self.assertEqual(self._counter(service, 'mkdir_calls'), 3)
+        self.assertTrue(os.path.isdir('directory/dir1/subdir'))
+        self.assertTrue(os.path.isdir('directory/dir2'))
+
+    def test_existing_files_are_still_detected(self):
+        service = BlobStorage('wasbs://container/dir')
+        service.list_blobs = self._list_blobs
+        os.makedirs('directory/dir1')
+        io.open('directory/dir1/file-3.txt','a').close()
+        res = list(service.get_download_path_pairs('directory', prefix=True, skip_existing=True))
+        self.assertEqual(len(res), 51)
+        self.assertNotIn(('dir1/file-3.txt', 'directory/dir1/file-3.txt'), res)
+
+    def test_precreate_skeleton(self):
+        service = BlobStorage('wasbs://container/dir')
+        service.list_blobs = self._list_blobs
+        res = list(service.get_download_path_pairs('directory', prefix=True, make_dirs=False))
+        self.assertEqual(len(res), 52)
+        self.assertFalse(os.path.exists('directory'))
+
+        service.make_directories(os.path.dirname(fp) for bp, fp in res)
+        self.assertEqual(self._counter(service, 'mkdir_calls'), 2)
+        self.assertTrue(os.path.isdir('directory/dir1/subdir'))
+        self.assertTrue(os.path.isdir('directory/dir2'))
+
+class TestTransferScheduler(unittest.TestCase):
+    MB = 1024 * 1024
+
+    def _run(self, budget, sizes):
+        budget = ConnectionBudget(budget)
+        lock, state = threading.Lock(), {'in_use': 0, 'peak': 0, 'order': [], 'connections': {}}
+
+        def task(size):
+            def task_fn(connections):
+                with lock:
+                    state['in_use'] += connections
+                    state['peak'] = max(state['peak'], state['in_use'])
+                    state['order'].append(size)
+                    state['connections'][size] = connections
+                time.sleep(0.01)
+                with lock:
+                    state['in_use'] -= connections
+            return size, task_fn
+
+        TransferScheduler(budget).run([task(size) for size in sizes])
+        self.assertEqual(budget.available, budget.size)
+        return state
+
+    def test_sequential_keeps_order(self):
+        state = self._run(1, [1, 300 * self.MB, 2])
+        self.assertEqual(state['order'], [1, 300 * self.MB, 2])
+        self.assertEqual(state['peak'], 1)
+
+    def test_largest_first_without_oversubscription(self):
+        sizes = [10 * self.MB + i for i in range(20)] + [200 * self.MB, 100 * self.MB] + list(range(20))
+        state = self._run(8, sizes)
+        self.assertEqual(state['order'][:2], [200 * self.MB, 100 * self.MB])
+        self.assertLessEqual(state['peak'], 8)
+        self.assertEqual(state['connections'][200 * self.MB], 4)
+        self.assertEqual(state['connections'][0], 1)
+
+    def test_errors_are_raised(self):
+        def failing(connections):
+            raise ValueError('failed')
+        with self.assertRaises(ValueError):
+            TransferScheduler(ConnectionBudget(4)).run([(1, failing), (2, lambda connections: None)])
+
+    def test_stream_does_not_read_ahead(self):
+        budget, produced, seen = ConnectionBudget(4), [], []
+
+        def tasks():
+            for i in range(100):
+                produced.append(i)
+                yield 0, lambda connections, i=i: seen.append((i, len(produced)))
+
+        TransferScheduler(budget).stream(tasks())
+        self.assertEqual(sorted(i for i, count in seen), list(range(100)))
+        # At most the queue and the running workers are ahead of the task being run.
+        self.assertTrue(all(count - i <= 4 * 2 + 4 + 1 for i, count in seen))
+        self.assertEqual(budget.available, budget.size)
+
+    def test_stream_errors_are_raised(self):
+        def failing(connections):
+            raise ValueError('failed')
+        with self.assertRaises(ValueError):
+            TransferScheduler(ConnectionBudget(3)).stream((0, failing) for i in range(50))
+
+    def test_block_size(self):
+        self.assertEqual(get_block_size(10 * self.MB, 1, MIN_UPLOAD_BLOCK_SIZE, MAX_UPLOAD_BLOCK_SIZE), MAX_UPLOAD_BLOCK_SIZE)
+        self.assertEqual(get_block_size(10 * self.MB, 4, MIN_UPLOAD_BLOCK_SIZE, MAX_UPLOAD_BLOCK_SIZE), MIN_UPLOAD_BLOCK_SIZE)
+        self.assertEqual(get_block_size(1024 * self.MB, 8, MIN_DOWNLOAD_CHUNK_SIZE, MAX_DOWNLOAD_CHUNK_SIZE), 32 * self.MB)
+
+    def test_tuned_service_is_a_copy(self):
+        os.environ['AZURE_STORAGE_ACCOUNT'] = 'account'
+        os.environ['AZURE_STORAGE_ACCESS_KEY'] = 'key'
+        storage = BlobStorage('wasbs://container/file.txt', max_connections=8)
+        self.assertIs(storage.get_service(1024 * self.MB, 1), storage.service)
+        service = storage.get_service(40 * self.MB, 8)
+        self.assertEqual(service.MAX_BLOCK_SIZE, MIN_UPLOAD_BLOCK_SIZE)
+        self.assertEqual(service.MAX_SINGLE_PUT_SIZE, 8 * MIN_UPLOAD_BLOCK_SIZE)
+        self.assertEqual(storage.service.MAX_BLOCK_SIZE, MAX_UPLOAD_BLOCK_SIZE)
+
+class TestRateLimiter(unittest.TestCase):
+    Request = TestStats.Request
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size('512'), 512)
+        self.assertEqual(parse_size('10M'), 10 * 1024 * 1024)
+        self.assertEqual(parse_size('1.5KiB'), 1536)
+        with self.assertRaises(InvalidLimit):
+            parse_size('fast')
+
+    def test_schedule(self):
+        schedule = LimitSchedule('08:00-20:00,22:30-06:00')
+        self.assertTrue(schedule.is_active(datetime.datetime(2016, 1, 1, 8, 0)))
+        self.assertFalse(schedule.is_active(datetime.datetime(2016, 1, 1, 20, 0)))
+        self.assertTrue(schedule.is_active(datetime.datetime(2016, 1, 1, 23, 0)))
+        self.assertTrue(schedule.is_active(datetime.datetime(2016, 1, 1, 5, 59)))
+        self.assertFalse(schedule.is_active(datetime.datetime(2016, 1, 1, 22, 0)))
+        with self.assertRaises(InvalidLimit):
+            LimitSchedule('8-20')
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(1000)
+        self.assertEqual(bucket.consume(1000), 0.0)
+        start = time.time()
+        bucket.consume(100)
+        bucket.consume(100)
+        self.assertGreaterEqual(time.time() - start, 0.15)
+
+    def test_token_bucket_is_shared_between_threads(self):
+        bucket, start = TokenBucket(100, 1), time.time()
+        threads = [threading.Thread(target=bucket.consume, args=(5,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreaterEqual(time.time() - start, 0.18)
+
+    def test_request_length(self):
+        self.assertEqual(get_request_length(self.Request('GET', '/c/b', headers=[('x-ms-range', 'bytes=100-199')])), 100)
+        self.assertEqual(get_request_length(self.Request('PUT', '/c/b', body=b'abc')), 3)
+        self.assertEqual(get_request_length(self.Request('DELETE', '/c/b')), 0)
+
+    def test_inactive_schedule(self):
+        now = datetime.datetime.now()
+        window = u'{0:02d}:{1:02d}-{0:02d}:{1:02d}'.format(now.hour, now.minute)
+        limiter = RateLimiter(1, 1, schedule=window)
+        self.assertEqual(limiter.before_request(self.Request('PUT', '/c/b', body=b'a' * 100)), 0.0)
+
+class FakeBlobService(object):
+    MAX_BLOCK_SIZE = 1024
+    MAX_SINGLE_PUT_SIZE = 2048
+    MAX_CHUNK_GET_SIZE = 1000
+    MAX_SINGLE_GET_SIZE = 2000
+
+    class Result(object):
+        def __init__(self, content=None, content_length=None, settings=None, metadata=None):
+            self.content = content
+            self.metadata = metadata
+            self.properties = type('Properties', (object,), {})()
+            self.properties.content_length = content_length
+            self.properties.content_settings = settings or ContentSettings()
+            self.properties.last_modified = datetime.datetime(2020, 1, 1)
+            self.properties.etag = u'0x{}'.format(hashlib.md5(content or b'').hexdigest()[:8])
+            self.properties.copy = None
+
+    def __init__(self):
+        self.blobs = {}
+        self.blocks = {}
+        self.copies = []
+        self.copy_statuses = ['success']
+
+    def create_blob_from_bytes(self, container, blob_path, data, content_settings=None, metadata=None):
+        self.blobs[blob_path] = (bytes(data), content_settings, metadata)
+
+    def put_block(self, container, blob_path, data, block_id):
+        self.blocks[(blob_path, block_id)] = bytes(data)
+
+    def put_block_list(self, container, blob_path, block_list, content_settings=None, metadata=None):
+        data = b''.join(self.blocks.pop((blob_path, block.id)) for block in block_list)
+        self.blobs[blob_path] = (data, content_settings, metadata)
+
+    def get_blob_to_path(self, container, blob_path, file_path, **kwargs):
+        with io.open(file_path, 'wb') as f:
+            f.write(self.blobs[blob_path][0])
+
+    def get_blob_to_bytes(self, container, blob_path, start_range=None, end_range=None):
+        return self.Result(self.blobs[blob_path][0][start_range:end_range + 1])
+
+    def get_blob_properties(self, container, blob_path):
+        if blob_path not in self.blobs:
+            raise AzureMissingResourceHttpError('The specified blob does not exist.', 404)
+        data, settings, metadata = self.blobs[blob_path]
+        result = self.Result(content_length=len(data), settings=settings, metadata=metadata)
+        result.name = blob_path
+        if blob_path in [copy[1] for copy in self.copies]:
+            result.properties.copy = self.get_copy()
+        return result
+
+    def get_copy(self):
+        copy = type('CopyProperties', (object,), {})()
+        copy.status = self.copy_statuses.pop(0) if len(self.copy_statuses) > 1 else self.copy_statuses[0]
+        return copy
+
+    def create_blob_from_stream(self, container, blob_path, stream, count=None, content_settings=None, metadata=None, **kwargs):
+        self.blobs[blob_path] = (stream.read(count), content_settings, metadata)
+
+    def make_blob_url(self, container, blob_path):
+        return u'https://account.blob.core.windows.net/{}/{}'.format(container, blob_path)
+
+    def copy_blob(self, container, blob_path, copy_source, source_if_match=None):
+        self.copies.append((container, blob_path, copy_source, source_if_match))
+        self.blobs[blob_path] = self.blobs[copy_source.split('/', 4)[-1]]
+        return self.get_copy()
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        os.environ['AZURE_STORAGE_ACCOUNT'] = 'account'
+        os.environ['AZURE_STORAGE_ACCESS_KEY'] = 'key'
+        self.content = b''.join(u'{},line,{}\n'.format(i, i * 7).encode('ascii') for i in range(3000))
+        with io.open('original.csv', 'wb') as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        for file_name in ['original.csv', 'restored.csv']:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+    def _roundtrip(self, codec, chunk_size=4096):
+        storage = BlobStorage('wasbs://container/original.csv', compress=codec, decompress=True, compress_workers=2)
+        service = storage.service = FakeBlobService()
+        reader = CompressingReader('original.csv', codec, storage.compress_executor, 2, chunk_size=chunk_size)
+        storage.put_stream(service, 'original.csv', reader, 3, ContentSettings(content_encoding=codec), reader.get_metadata)
+        reader.close()
+
+        data, settings, metadata = service.blobs['original.csv']
+        self.assertLess(len(data), len(self.content))
+        self.assertEqual(settings.content_encoding, codec)
+        self.assertEqual(metadata[RAW_LENGTH_METADATA], str(len(self.content)))
+
+        storage.download_fn('original.csv', 'restored.csv')
+        self.assertEqual(io.open('restored.csv', 'rb').read(), self.content)
+        return storage
+
+    def test_gzip(self):
+        self._roundtrip('gzip')
+
+    @unittest.skipIf(zstandard is None, 'zstandard is not installed')
+    def test_zstd(self):
+        self._roundtrip('zstd')
+
+    def test_gzip_members_are_standard(self):
+        import gzip
+        storage = self._roundtrip('gzip', chunk_size=1000)
+        data = storage.service.blobs['original.csv'][0]
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(data)).read(), self.content)
+
+    def _split_at_frame_boundary(self, codec):
+        compress = get_compressor(codec)
+        first, second = compress(self.content[:1000]), compress(self.content[1000:])
+        decompressor = Decompressor(codec)
+        self.assertEqual(decompressor.decompress(first) + decompressor.decompress(second), self.content)
+
+    def test_gzip_split_at_frame_boundary(self):
+        self._split_at_frame_boundary('gzip')
+
+    @unittest.skipIf(zstandard is None, 'zstandard is not installed')
+    def test_zstd_split_at_frame_boundary(self):
+        self._split_at_frame_boundary('zstd')
+
+    def test_empty_file(self):
+        io.open('original.csv', 'wb').close()
+        self.content = b''
+        storage = BlobStorage('wasbs://container/original.csv', compress='gzip', decompress=True)
+        storage.service = FakeBlobService()
+        storage.upload_fn('original.csv', 'original.csv')
+        storage.download_fn('original.csv', 'restored.csv')
+        self.assertEqual(io.open('restored.csv', 'rb').read(), b'')
+
+    def test_sync_uses_the_original_size_and_hash(self):
+        blob = TestListFormats.Blob(u'original.csv', 123, metadata={
+            RAW_LENGTH_METADATA: str(len(self.content)),
+            RAW_MD5_METADATA: base64.b64encode(hashlib.md5(self.content).digest()).decode('ascii')})
+        blob.content_encoding = 'gzip'
+        blob.last_modified = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC) + datetime.timedelta(minutes=5)
+        self.assertIsNone(get_fresher(blob, 'original.csv', raw=True))
+        self.assertEqual(get_fresher(blob, 'original.csv'), blob)
+
+class TestDedup(unittest.TestCase):
+    def setUp(self):
+        os.environ['AZURE_STORAGE_ACCOUNT'] = 'account'
+        os.environ['AZURE_STORAGE_ACCESS_KEY'] = 'key'
+        with io.open('original.csv', 'wb') as f:
+            f.write(b'a,b,c\n1,2,3\n')
+        self.digest = hashlib.md5(b'a,b,c\n1,2,3\n').digest()
+
+    def tearDown(self):
+        for file_name in ['original.csv', 'manifest.jsonl']:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+    def _storage(self, source_content=b'a,b,c\n1,2,3\n'):
+        index = DedupIndex()
+        index.add_blobs([Blob(u'old/original.csv', 12, content_md5=self.digest, url_prefix=u'wasbs://archive/')])
+        storage = BlobStorage('wasbs://container/dir', dedup_index=index)
+        storage.service = FakeBlobService()
+        if source_content is not None:
+            storage.service.blobs['old/original.csv'] = (source_content, \
+                ContentSettings(content_md5=base64.b64encode(hashlib.md5(source_content).digest()).decode('ascii')), None)
+        return storage
+
+    def test_copies_known_content(self):
+        storage = self._storage()
+        self.assertEqual(storage.upload_fn('dir/original.csv', 'original.csv', size=12), u'OK (copied from `wasbs://archive/old/original.csv`)')
+        etag = storage.service.get_blob_properties('archive', 'old/original.csv').properties.etag
+        self.assertEqual(storage.service.copies, [('container', 'dir/original.csv', \
+            u'https://account.blob.core.windows.net/archive/old/original.csv', etag)])
+        self.assertEqual(storage.service.blobs['dir/original.csv'], storage.service.blobs['old/original.csv'])
+        self.assertEqual(storage.stats.counters[('dedup_bytes', ())], 12)
+
+    def test_waits_for_pending_copy(self):
+        storage = self._storage()
+        storage.service.copy_statuses = ['pending', 'pending', 'success']
+        sleep, time.sleep = time.sleep, lambda seconds: None
+        try:
+            self.assertEqual(storage.upload_fn('dir/original.csv', 'original.csv'), u'OK (copied from `wasbs://archive/old/original.csv`)')
+        finally:
+            time.sleep = sleep
+
+    def test_failed_copy_is_uploaded(self):
+        storage = self._storage()
+        storage.service.copy_statuses = ['failed']
+        self.assertIsNone(storage.upload_fn('dir/original.csv', 'original.csv'))
+        self.assertEqual(storage.service.blobs['dir/original.csv'][0], b'a,b,c\n1,2,3\n')
+
+    def test_stale_source_is_uploaded(self):
+        for storage in [self._storage(b'overwritten'), self._storage(None)]:
+            self.assertIsNone(storage.upload_fn('dir/original.csv', 'original.csv'))
+            self.assertEqual(storage.service.copies, [])
+            self.assertEqual(storage.service.blobs['dir/original.csv'][0], b'a,b,c\n1,2,3\n')
+            self.assertEqual(storage.dedup_index.lookup(self.digest), u'wasbs://container/dir/original.csv')
+
+    def test_uploads_new_content_with_md5(self):
+        storage = BlobStorage('wasbs://container/dir', dedup_index=DedupIndex('manifest.jsonl'))
+        storage.service = FakeBlobService()
+        self.assertIsNone(storage.upload_fn('dir/original.csv', 'original.csv'))
+        self.assertEqual(storage.service.blobs['dir/original.csv'][1].content_md5, base64.b64encode(self.digest).decode('ascii'))
+        self.assertEqual(storage.upload_fn('dir/original.csv', 'original.csv'), 'OK (unchanged)')
+        storage.dedup_index.close()
+
+        index = DedupIndex('manifest.jsonl')
+        self.assertEqual(index.lookup(self.digest), u'wasbs://container/dir/original.csv')
+        self.assertIsNone(index.lookup(self.digest, 'gzip'))
+        index.close()
+
+class TestCheckpoint(unittest.TestCase):
+    class Service(object):
+        class Page(list):
+            next_marker = None
+
+        def __init__(self, pages, fail=(), missing=()):
+            self.pages = pages
+            self.fail = set(fail)
+            self.missing = set(missing)
+            self.markers = []
+            self.deleted = []
+
+        def list_blobs(self, container, prefix=None, marker=None, include=None):
+            self.markers.append(marker)
+            index = int(marker or 0)
+            page = self.Page(self.blob(name) for name in self.pages[index])
+            page.next_marker = str(index + 1) if index + 1 < len(self.pages) else None
+            return page
+
+        def blob(self, name):
+            blob = type('SdkBlob', (object,), {})()
+            blob.name, blob.metadata = name, None
+            blob.properties = type('Properties', (object,), {})()
+            blob.properties.content_length = 10
+            blob.properties.last_modified = datetime.datetime(2020, 1, 1, 12, 0)
+            blob.properties.etag = '0x1'
+            blob.properties.content_settings = ContentSettings()
+            return blob
+
+        def delete_blob(self, container, path):
+            if path in self.fail:
+                raise RuntimeError('Server busy')
+            if path in self.missing:
+                raise AzureMissingResourceHttpError('The specified blob does not exist.', 404)
+            self.deleted.append(path)
+
+        def get_blob_to_path(self, container, path, file_path, **kwargs):
+            if path in self.missing:
+                raise AzureMissingResourceHttpError('The specified blob does not exist.', 404)
+            with io.open(file_path, 'wb') as f:
+                f.write(b'0123456789')
+
+    def setUp(self):
+        os.environ['AZURE_STORAGE_ACCOUNT'] = 'account'
+        os.environ['AZURE_STORAGE_ACCESS_KEY'] = 'key'
+
+    def tearDown(self):
+        if os.path.exists('checkpoint.json'):
+            os.remove('checkpoint.json')
+        if os.path.exists('restored'):
+            shutil.rmtree('restored')
+
+    def _remove(self, service, interval=0):
+        storage = BlobStorage('wasbs://container/dir')
+        storage.service = service
+        storage.checkpoint = Checkpoint('checkpoint.json', storage.container, storage.blob_path, interval)
+        storage.remove_blobs(prefix=True)
+        storage.checkpoint.close()
+        return storage
+
+    def test_resumes_the_failed_blobs_and_the_listing(self):
+        pages = [['dir/a', 'dir/b'], ['dir/c']]
+        storage = self._remove(self.Service(pages, fail=['dir/b']))
+        self.assertEqual(storage.service.deleted, ['dir/a', 'dir/c'])
+        with io.open('checkpoint.json') as f:
+            state = json.load(f)
+        self.assertEqual([path for path, record in state['failed']], ['dir/b'])
+        self.assertEqual((state['listed'], state['completed'], state['finished']), (True, 2, []))
+
+        storage = self._remove(self.Service(pages))
+        self.assertEqual(storage.service.deleted, ['dir/b'])
+        self.assertEqual(storage.service.markers, [])
+        self.assertFalse(os.path.exists('checkpoint.json'))
+
+    def test_saves_only_the_unfinished_pages(self):
+        checkpoint = Checkpoint('checkpoint.json', 'container', 'dir')
+        blobs = [Blob(u'dir/a', 10), Blob(u'dir/b', 10)]
+        self.assertEqual(checkpoint.add_page(None, blobs, '1'), blobs)
+        checkpoint.complete('dir/a')
+        checkpoint.save()
+        with io.open('checkpoint.json') as f:
+            state = json.load(f)
+        self.assertEqual((state['marker'], state['finished']), (None, ['dir/a']))
+
+        checkpoint.complete('dir/b')
+        checkpoint.save()
+        with io.open('checkpoint.json') as f:
+            state = json.load(f)
+        self.assertEqual((state['marker'], state['finished'], state['listed']), ('1', [], False))
+
+    def test_continues_from_the_oldest_unfinished_page(self):
+        checkpoint = Checkpoint('checkpoint.json', 'container', 'dir')
+        checkpoint.add_page(None, [Blob(u'dir/a', 10), Blob(u'dir/b', 10)], '1')
+        checkpoint.complete('dir/a')
+        checkpoint.save()
+
+        service = self.Service([['dir/a', 'dir/b'], ['dir/c']])
+        self._remove(service)
+        self.assertEqual(service.deleted, ['dir/b', 'dir/c'])
+        self.assertEqual(service.markers, [None, '1'])
+        self.assertFalse(os.path.exists('checkpoint.json'))
+
+    def test_deleted_blobs_are_done(self):
+        storage = self._remove(self.Service([['dir/a', 'dir/b'], ['dir/c']], missing=['dir/b']))
+        self.assertEqual(storage.service.deleted, ['dir/a', 'dir/c'])
+        self.assertEqual(storage.stats.counters[('missing_blobs', ())], 1)
+        self.assertFalse(os.path.exists('checkpoint.json'))
+
+    def test_get_skips_deleted_blobs(self):
+        storage = BlobStorage('wasbs://container/dir/')
+        storage.service = self.Service([['dir/a', 'dir/b']], missing=['dir/a'])
+        storage.checkpoint = Checkpoint('checkpoint.json', storage.container, storage.blob_path, 0)
+        storage.download_blobs('restored/', prefix=True)
+        storage.checkpoint.close()
+        self.assertEqual(sorted(os.listdir('restored')), ['b'])
+        self.assertFalse(os.path.exists('checkpoint.json'))
+
+    def test_rejects_other_prefix(self):
+        Checkpoint('checkpoint.json', 'container', 'dir/').save()
+        self.assertRaises(InvalidCheckpoint, Checkpoint, 'checkpoint.json', 'container', 'other/')
+
+    def test_blob_record_roundtrip(self):
+        blob = Blob(u'dir/a', 10, datetime.datetime(2020, 1, 1, 12, 30, tzinfo=pytz.UTC), b'\x01' * 16, '0x1', \
+            'text/csv', 'gzip', {RAW_LENGTH_METADATA: '20'})
+        restored = Blob.from_record(blob.path, json.loads(json.dumps(blob.to_record())))
+        self.assertEqual([getattr(restored, name) for name in Blob.__slots__], [getattr(blob, name) for name in Blob.__slots__])
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        os.environ['AZURE_STORAGE_ACCOUNT'] = 'account'
+        os.environ['AZURE_STORAGE_ACCESS_KEY'] = 'key'
+        self.streams = sys.stdout, sys.stderr
+        self.calls = []
+        COMMANDS['echo'] = (None, self._echo)
+        self.daemon = Daemon(os.path.abspath('daemon.sock'), max_connections=3)
+        self.daemon.start()
+        self.thread = threading.Thread(target=self.daemon.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.daemon.server.shutdown()
+        self.thread.join()
+        sys.stdout, sys.stderr = self.streams
+        del COMMANDS['echo']
+
+    def _echo(self, args, daemon=None):
+        self.calls.append((args, daemon))
+        def worker():
+            print(u'from worker')
+        thread = threading.Thread(target=inherit_output(worker))
+        thread.start()
+        thread.join()
+        print(u'from {}'.format(args.wasbs_path), file=sys.stderr)
+        if getattr(args, 'binary', False):
+            getattr(sys.stdout, 'buffer', sys.stdout).write(b'\xff\x00\xfe\n')
+        if args.fail:
+            sys.exit(3)
+
+    def _forward(self, **arguments):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        sys.stdout.local.stream, sys.stderr.local.stream = stdout, stderr
+        try:
+            code = forward('daemon.sock', 'echo', argparse.Namespace(**arguments))
+        finally:
+            sys.stdout.local.stream = sys.stderr.local.stream = None
+        return code, stdout.getvalue(), stderr.getvalue()
+
+    def test_forward_streams_the_output(self):
+        code, stdout, stderr = self._forward(wasbs_path='wasbs://container/dir', file_path=['dir/', 'file.txt'], fail=False, daemon='daemon.sock')
+        self.assertEqual((code, stdout, stderr), (0, u'from worker\n', u'from wasbs://container/dir\n'))
+
+        args, daemon = self.calls[0]
+        self.assertEqual(args.file_path, [os.path.join(os.path.abspath('dir'), ''), os.path.abspath('file.txt')])
+        self.assertIsNone(args.daemon)
+        self.assertIs(daemon, self.daemon)
+
+    def test_daemon_is_not_running(self):
+        stderr = io.StringIO()
+        sys.stderr.local.stream = stderr
+        try:
+            code = forward(os.path.abspath('missing.sock'), 'echo', argparse.Namespace(wasbs_path='wasbs://container/dir', fail=False))
+        finally:
+            sys.stderr.local.stream = None
+        self.assertEqual(code, 1)
+        self.assertIn(u'Can not connect to the daemon', stderr.getvalue())
+
+    def test_binary_output(self):
+        stdout = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+        sys.stdout.local.stream, sys.stderr.local.stream = stdout, io.StringIO()
+        try:
+            code = forward('daemon.sock', 'echo', argparse.Namespace(wasbs_path='wasbs://container/dir', fail=False, binary=True))
+        finally:
+            sys.stdout.local.stream = sys.stderr.local.stream = None
+        stdout.flush()
+        self.assertEqual((code, stdout.buffer.getvalue()), (0, b'from worker\n\xff\x00\xfe\n'))
+
+    def test_profile_is_refused(self):
+        code, stdout, stderr = self._forward(wasbs_path='wasbs://container/dir', fail=False, profile='profile.out')
+        self.assertEqual(code, 1)
+        self.assertIn(u'--profile is not supported', stderr)
+        self.assertEqual(self.calls, [])
+        self.assertFalse(os.path.exists('profile.out'))
+
+    def test_exit_code(self):
+        self.assertEqual(self._forward(wasbs_path='wasbs://container/dir', fail=True)[0], 3)
+
+    def test_socket_is_private(self):
+        self.assertEqual(os.stat('daemon.sock').st_mode & 0o777, 0o600)
+
+    def test_second_daemon_is_refused(self):
+        self.assertRaises(DaemonIsRunning, Daemon(os.path.abspath('daemon.sock')).start)
+
+    def test_jobs_share_the_daemon(self):
+        args = get_ls_parser().parse_args(['wasbs://container/dir'])
+        storage = create_storage(args, daemon=self.daemon)
+        self.assertIs(storage.budget, self.daemon.budget)
+        self.assertIs(storage.service._httpclient.request_session, self.daemon.session)
+
+    def test_listing_cache(self):
+        storage = BlobStorage('wasbs://container/dir', listing_cache=self.daemon.listing_cache)
+        storage.list_remote_blobs = lambda include_metadata: iter([Blob(u'dir/a.txt')])
+        self.assertEqual([blob.path for blob in storage.list_blobs(cached=True)], [u'dir/a.txt'])
+        storage.list_remote_blobs = lambda include_metadata: iter([])
+        self.assertEqual([blob.path for blob in storage.list_blobs(cached=True)], [u'dir/a.txt'])
+        self.daemon.listing_cache.invalidate('container')
+        self.assertEqual(list(storage.list_blobs(cached=True)), [])
+
+    def test_transfers_do_not_use_the_listing_cache(self):
+        storage = BlobStorage('wasbs://container/dir', listing_cache=self.daemon.listing_cache)
+        self.daemon.listing_cache.put(('container', 'dir', False), [Blob(u'dir/old.txt')])
+        listing = iter([Blob(u'dir/a.txt')])
+        storage.list_remote_blobs = lambda include_metadata: listing
+        # The streamed listing is not read into memory for the cache.
+        self.assertIs(storage.list_blobs(), listing)
+        self.assertEqual(self.daemon.listing_cache.get(('container', 'dir', False))[0].path, u'dir/old.txt')
+
+    def test_dedup_index_shares_the_daemon(self):
+        args = get_put_parser().parse_args(['file.txt', 'wasbs://container/dir/'])
+        storage = create_storage(args, daemon=self.daemon)
+        self.daemon.listing_cache.put(('archive', 'old/', True), [Blob(u'old/a.txt', 10, content_md5=b'\x01' * 16, url_prefix=u'wasbs://archive/')])
+        index = storage.build_dedup_index(['wasbs://archive/old/'])
+        self.assertEqual(index.lookup(b'\x01' * 16, None), u'wasbs://archive/old/a.txt')
+
+class TestRanges(unittest.TestCase):
+    def setUp(self):
+        os.environ['AZURE_STORAGE_ACCOUNT'] = 'account'
+        os.environ['AZURE_STORAGE_ACCESS_KEY'] = 'key'
+        self.content = b''.join(u'{:04d}\n'.format(i).encode('ascii') for i in range(1000))
+        self.storage = BlobStorage('wasbs://container/dir')
+        self.storage.service = FakeBlobService()
+        self.storage.service.blobs['dir/a.csv'] = (self.content, None, None)
+        self.storage.service.blobs['dir/b.csv'] = (self.content[:10], None, None)
+
+    def tearDown(self):
+        if os.path.exists('part.csv'):
+            os.remove('part.csv')
+
+    def _download(self, byte_range, blob_path='dir/a.csv', connections=3):
+        self.storage.byte_range = byte_range
+        self.storage.download_fn(blob_path, 'part.csv', connections=connections)
+        return io.open('part.csv', 'rb').read()
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range('10-20'), (10, 20))
+        self.assertEqual(parse_range('4096-'), (4096, None))
+        self.assertRaises(InvalidLimit, parse_range, '20-10')
+        self.assertRaises(InvalidLimit, parse_range, '-10')
+
+    def test_range(self):
+        self.assertEqual(self._download((1000, 3499)), self.content[1000:3500])
+        self.assertEqual(self._download((4990, None)), self.content[4990:])
+        self.assertEqual(self._download((6000, 7000)), b'')
+
+    def test_head_and_tail(self):
+        self.assertEqual(self._download((0, 2499)), self.content[:2500])
+        self.assertEqual(self._download((-2500, None)), self.content[-2500:])
+        self.assertEqual(self._download((-2500, None), 'dir/b.csv'), self.content[:10])
+        self.assertEqual(self.storage.stats.counters[('range_bytes', ())], 5010)
+
+    def test_stdout_with_prefix(self):
+        output = io.BytesIO()
+        stdout, sys.stdout = sys.stdout, type('Stdout', (object,), {'buffer': output})()
+        self.storage.list_blobs = lambda: iter([Blob(u'dir/a.csv', len(self.content)), Blob(u'dir/b.csv', 10)])
+        self.storage.byte_range, self.storage.range_headers, self.storage.output = (0, 4), True, io.StringIO()
+        self.storage.budget = ConnectionBudget(2)
+        try:
+            self.storage.download_blobs(STDOUT_PATH, prefix=True)
+        finally:
+            sys.stdout = stdout
+        data = output.getvalue()
+        self.assertIn(b'==> wasbs://container/dir/a.csv <==\n0000\n', data)
+        self.assertIn(b'==> wasbs://container/dir/b.csv <==\n0000\n', data)
+        self.assertEqual(len(data), 2 * len(b'==> wasbs://container/dir/a.csv <==\n0000\n'))
+        self.assertFalse(os.path.exists(STDOUT_PATH))
+
+    def _stdout(self, concurrent, buffer_size=STDOUT_BUFFER_SIZE):
+        writes, fetched = [], []
+        get_blob_to_bytes = self.storage.service.get_blob_to_bytes
+        def fetch(*args, **kwargs):
+            fetched.append(len(writes))
+            return get_blob_to_bytes(*args, **kwargs)
+        self.storage.service.get_blob_to_bytes = fetch
+        self.storage.concurrent, self.storage.stdout_buffer_size = concurrent, buffer_size
+        stdout, sys.stdout = sys.stdout, type('Stdout', (object,), {'buffer': type('Buffer', (object,), \
+            {'write': lambda self, data: writes.append(data), 'flush': lambda self: None})()})()
+        try:
+            self.storage.download_range(self.storage.service, 'dir/a.csv', STDOUT_PATH, 0, 2499)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(b''.join(writes), self.content[:2500])
+        return fetched
+
+    def test_stdout_streams_the_chunks(self):
+        # The last chunk is downloaded after the first one was written.
+        self.assertGreater(self._stdout(False)[-1], 0)
+
+    def test_stdout_buffers_the_concurrent_slices(self):
+        self.assertEqual(self._stdout(True)[-1], 0)
+        self.assertGreater(self._stdout(True, buffer_size=1000)[-1], 0)
+
+    def test_not_supported_with_decompress(self):
+        args = get_get_parser().parse_args(['--head', '1K', '--decompress', 'wasbs://container/dir', 'part.csv'])
+        self.assertRaises(NotSupported, run_get, args)
+
+class TestBlobCache(unittest.TestCase):
+    def setUp(self):
+        os.environ['AZURE_STORAGE_ACCOUNT'] = 'account'
+        os.environ['AZURE_STORAGE_ACCESS_KEY'] = 'key'
+        os.makedirs('directory')
+
+    def tearDown(self):
+        for path in ['directory', 'cache']:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+
+    def _storage(self, cache):
+        storage = BlobStorage('wasbs://container/dir')
+        storage.service = FakeBlobService()
+        storage.service.blobs['dir/a.csv'] = (b'a,b\n1,2\n', None, None)
+        storage.listed_blobs['dir/a.csv'] = Blob(u'dir/a.csv', 8, etag='0x1')
+        storage.cache = cache
+        return storage
+
+    def test_second_download_is_served_from_the_cache(self):
+        for mode in CACHE_MODES:
+            cache = BlobCache('cache', 1024, mode)
+            storage = self._storage(cache)
+            self.assertIsNone(storage.download_fn('dir/a.csv', 'directory/a.csv'))
+
+            del storage.service.blobs['dir/a.csv']
+            self.assertEqual(storage.download_fn('dir/a.csv', 'directory/b.csv'), 'OK (cached)')
+            self.assertEqual(io.open('directory/b.csv', 'rb').read(), b'a,b\n1,2\n')
+            self.assertEqual(storage.stats.counters[('cache_hits', ())], 1)
+            self.assertEqual(sorted(os.listdir('directory')), ['a.csv', 'b.csv'])
+            shutil.rmtree('cache')
+
+    def test_new_version_is_a_miss(self):
+        cache = BlobCache('cache', 1024)
+        storage = self._storage(cache)
+        storage.download_fn('dir/a.csv', 'directory/a.csv')
+        storage.listed_blobs['dir/a.csv'] = Blob(u'dir/a.csv', 8, etag='0x2')
+        self.assertIsNone(storage.download_fn('dir/a.csv', 'directory/a.csv'))
+        self.assertEqual(storage.stats.counters[('cache_misses', ())], 2)
+
+    def test_hardlinked_entries_are_not_overwritten(self):
+        cache = BlobCache('cache', 1024, 'hardlink')
+        storage = self._storage(cache)
+        storage.download_fn('dir/a.csv', 'directory/a.csv')
+        key = cache.get_key(storage.account, 'container', storage.listed_blobs['dir/a.csv'])
+        self.assertEqual(os.stat('directory/a.csv').st_nlink, 2)
+
+        storage.service.blobs['dir/a.csv'] = (b'a,b\n3,4\n', None, None)
+        storage.listed_blobs['dir/a.csv'] = Blob(u'dir/a.csv', 8, etag='0x2')
+        storage.download_fn('dir/a.csv', 'directory/a.csv')
+        self.assertEqual(io.open('directory/a.csv', 'rb').read(), b'a,b\n3,4\n')
+        self.assertEqual(io.open(cache.get_entry_path(key), 'rb').read(), b'a,b\n1,2\n')
+
+    def test_hardlinked_use_does_not_touch_the_files(self):
+        cache = BlobCache('cache', 1024, 'hardlink')
+        storage = self._storage(cache)
+        storage.download_fn('dir/a.csv', 'directory/a.csv')
+        os.utime('directory/a.csv', (1000, 1000))
+        self.assertEqual(storage.download_fn('dir/a.csv', 'directory/b.csv'), 'OK (cached)')
+        self.assertEqual(os.stat('directory/a.csv').st_mtime, 1000)
+
+        key = cache.get_key(storage.account, 'container', storage.listed_blobs['dir/a.csv'])
+        self.assertGreater(os.stat(cache.get_entry_path(key) + CACHE_USED_SUFFIX).st_mtime, 1000)
+        cache.max_size = 0
+        self.assertEqual(cache.evict(), 1)
+        self.assertEqual(os.listdir(os.path.dirname(cache.get_entry_path(key))), [])
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = BlobCache('cache', 25)
+        for i in range(3):
+            with io.open('directory/file.txt', 'wb') as f:
+                f.write(b'x' * 10)
+            cache.store(u'{:064d}'.format(i), 'directory/file.txt')
+            os.utime(cache.get_entry_path(u'{:064d}'.format(i)), (1000 + i, 1000 + i))
+        self.assertEqual(cache.size, 20)
+        self.assertEqual(cache.evict(), 0)
+        self.assertFalse(cache.fetch(u'{:064d}'.format(0), 'directory/restored.txt'))
+        self.assertTrue(cache.fetch(u'{:064d}'.format(2), 'directory/restored.txt'))
+        self.assertEqual(os.listdir('cache/tmp'), [])
+
+    def test_eviction_leaves_room_for_the_next_entries(self):
+        cache = BlobCache('cache', 40)
+        with io.open('directory/file.txt', 'wb') as f:
+            f.write(b'x' * 10)
+        for i in range(5):
+            cache.store(u'{:064d}'.format(i), 'directory/file.txt')
+            os.utime(cache.get_entry_path(u'{:064d}'.format(i)), (1000 + i, 1000 + i))
+        # Evicted below 90%, not just below the limit.
+        self.assertEqual(cache.size, 30)
+        self.assertFalse(cache.fetch(u'{:064d}'.format(1), 'directory/restored.txt'))
+        self.assertTrue(cache.fetch(u'{:064d}'.format(2), 'directory/restored.txt'))
@@ -16,14 +16,19 @@ setup(
     install_requires = [
         'azure-storage',
         "pytz",
-        "progressbar2"
+        "progressbar2",
+        'futures; python_version < "3"'
     ],
+    extras_require = {
+        'zstd': ['zstandard']
+    },
     entry_points = {
         'console_scripts': [
             'azrcmd-ls = azrcmd:ls',
             'azrcmd-put = azrcmd:put',
             'azrcmd-rm = azrcmd:rm',
-            'azrcmd-get = azrcmd:get'
+            'azrcmd-get = azrcmd:get',
+            'azrcmd-daemon = azrcmd:daemon'
         ],
     },
     test_suite = 'azrcmd.tests',